@@ -1,30 +1,162 @@
-from flask import Flask, render_template, redirect, url_for
+from flask import Flask, render_template, redirect, url_for, request, jsonify, abort, make_response, send_from_directory, Response, stream_with_context
+import os
 from flask_pymongo import PyMongo
-import scraping
+import mars_store
+import image_store
+import metrics
+import web_common
+from jobs import JobQueue
+from mars_cache import DocumentCache
 
 app = Flask(__name__)
 
 # Tell Python how to connect to Mongo using PyMongo
 # Use flask_pymongo to set up mongo connection
-app.config["MONGO_URI"] = "mongodb://localhost:27017/mars_app"
-mongo = PyMongo(app)
+app.config["MONGO_URI"] = os.environ.get("MONGO_URI", "mongodb://localhost:27017/mars_app")
 
+# Connection pool settings for the PyMongo client
+app.config["MONGO_MAX_POOL_SIZE"] = int(os.environ.get("MONGO_MAX_POOL_SIZE", 50))
+app.config["MONGO_MIN_POOL_SIZE"] = int(os.environ.get("MONGO_MIN_POOL_SIZE", 0))
+app.config["MONGO_MAX_IDLE_TIME_MS"] = int(os.environ.get("MONGO_MAX_IDLE_TIME_MS", 60000))
+app.config["MONGO_WAIT_QUEUE_TIMEOUT_MS"] = int(os.environ.get("MONGO_WAIT_QUEUE_TIMEOUT_MS", 2000))
+mongo = PyMongo(
+    app,
+    maxPoolSize=app.config["MONGO_MAX_POOL_SIZE"],
+    minPoolSize=app.config["MONGO_MIN_POOL_SIZE"],
+    maxIdleTimeMS=app.config["MONGO_MAX_IDLE_TIME_MS"],
+    waitQueueTimeoutMS=app.config["MONGO_WAIT_QUEUE_TIMEOUT_MS"])
+mars_store.ensure_indexes(mongo.db)
+
+# Index reads are served from memory until the mars document changes
+mars_cache = DocumentCache(mongo.db.mars)
+
+# Scrapes run in worker.py, the web app only queues them. Concurrent requests
+# share the job in flight
+jobs = JobQueue(mongo.db.scrape_jobs, total=len(mars_store.SOURCES))
+jobs.ensure_indexes()
 
 
 # Define the flask root route
 @app.route("/")
 def index():
-    mars = mongo.db.mars.find_one()
+    mars = mars_cache.get()
     #img_dict = mongo.db.mars.find({'hemisphere_image_urls.0.img_url'})
-    return render_template("index.html", mars=mars)
+
+    # Serve what is stored right away, stale sources are refreshed in the background
+    refresh_stale(mars)
+
+    # Show the progress of a scrape started from this page, this view is never cached
+    job_id = request.args.get("job")
+    job = jobs.follow(job_id) if job_id else None
+    if job is not None:
+        with metrics.span("render", metrics.TEMPLATE_RENDER_SECONDS, template="index.html"):
+            return render_template("index.html", mars=mars, job=job)
+
+    # The page only changes when a scrape writes a new document
+    last_modified = mars.get("last_modified") if mars else None
+    response = make_response(render_index(mars, last_modified))
+    if last_modified is not None:
+        response.set_etag(last_modified.isoformat())
+        response.last_modified = last_modified
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+
+# Page views queue a scrape of the sources past their TTL, at most once per
+# REFRESH_INTERVAL, and the queue joins a scrape that is already in flight
+refresh_throttle = web_common.RefreshThrottle()
+
+def refresh_stale(mars):
+    stale = refresh_throttle.stale(mars)
+    if stale:
+        jobs.submit(sources=stale)
+
+
+# Rendered index page, keyed by the document's last_modified
+page_cache = web_common.PageCache()
+
+def render_index(mars, last_modified):
+    return page_cache.get(last_modified, lambda: render_template("index.html", mars=mars, job=None))
+
 
 # Set up the scraping route
 @app.route("/scrape")
 def scrape():
-    mars = mongo.db.mars
-    mars_data = scraping.scrape_all()
-    mars.update_one({}, {"$set":mars_data}, upsert=True)
-    return redirect('/', code=302)
+    job = jobs.submit()
+    if request.accept_mimetypes.best == "application/json":
+        return jsonify(job.to_dict()), 202
+    return redirect(url_for("index", job=job.id), code=302)
+
+# Serve mirrored images, names are content hashes so they never change
+@app.route("/images/<path:name>")
+def image(name):
+    response = send_from_directory(os.path.abspath(image_store.IMAGE_DIR), name, max_age=31536000)
+    response.cache_control.immutable = True
+    response.cache_control.public = True
+    return response
+
+# Report the progress of a scrape job
+@app.route("/scrape/<job_id>")
+def scrape_status(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        abort(404)
+    return jsonify(job.to_dict())
+
+# The scraped mars document as JSON, `?fields=a,b` selects fields
+@app.route("/api/mars")
+def api_mars():
+    try:
+        fields = web_common.api_fields(request.args.get("fields"))
+    except ValueError:
+        abort(400)
+
+    mars = mars_cache.get() or {}
+    body, encoding, etag = web_common.api_mars(mars, fields, request.headers.get("Accept-Encoding"))
+    last_modified = mars.get("last_modified")
+    response = Response(mimetype="application/json")
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    response.cache_control.no_cache = True
+    response.vary.add("Accept-Encoding")
+
+    response = response.make_conditional(request)
+    if response.status_code != 304:
+        response.set_data(web_common.compress(body, encoding))
+        if encoding:
+            response.content_encoding = encoding
+    return response
+
+# Snapshot history as NDJSON, one change per line, streamed from the cursor
+@app.route("/api/mars/history.ndjson")
+def api_mars_history():
+    try:
+        start, end = web_common.history_range(request.args)
+    except ValueError:
+        abort(400)
+    changes = mars_store.history(mongo.db, start, end, request.args.get("source"))
+    gzipped = "gzip" in web_common.accepted_encodings(request.headers.get("Accept-Encoding"))
+
+    response = Response(stream_with_context(web_common.ndjson_lines(changes, gzipped)), mimetype="application/x-ndjson")
+    if gzipped:
+        response.content_encoding = "gzip"
+    response.vary.add("Accept-Encoding")
+    return response
+
+# Cursor-paginated news archive, newest first
+@app.route("/api/news")
+def api_news():
+    try:
+        page = web_common.news(mongo.db, request.args.get("cursor"), request.args.get("limit", 20))
+    except ValueError:
+        abort(400)
+    return Response(web_common.to_json(page), mimetype="application/json")
+
+# Prometheus metrics of this web process, the worker serves its own
+@app.route("/metrics")
+def metrics_endpoint():
+    return Response(metrics.render(), mimetype=metrics.CONTENT_TYPE)
 
 # Tell Flask to run
 if __name__ == "__main__":
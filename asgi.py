@@ -0,0 +1,213 @@
+# Production serving mode: an ASGI app on an async Mongo driver
+#
+#   python asgi.py                      (uvicorn, WEB_CONCURRENCY worker processes)
+#   uvicorn asgi:app --workers 4
+#
+# Scrapes still run in worker.py, this app only reads the mars document and queues jobs
+import os
+from motor.motor_asyncio import AsyncIOMotorClient
+from starlette.applications import Starlette
+from starlette.exceptions import HTTPException
+from starlette.responses import FileResponse, HTMLResponse, JSONResponse, RedirectResponse, Response, StreamingResponse
+from starlette.routing import Route
+from starlette.templating import Jinja2Templates
+import image_store
+import mars_store
+import metrics
+import web_common
+from jobs import AsyncJobQueue
+from mars_cache import AsyncDocumentCache
+
+
+MONGO_URI = os.environ.get('MONGO_URI', 'mongodb://localhost:27017/mars_app')
+
+# Connection pool per worker process
+MONGO_MAX_POOL_SIZE = int(os.environ.get('MONGO_MAX_POOL_SIZE', 100))
+MONGO_MIN_POOL_SIZE = int(os.environ.get('MONGO_MIN_POOL_SIZE', 10))
+MONGO_MAX_IDLE_TIME_MS = int(os.environ.get('MONGO_MAX_IDLE_TIME_MS', 60000))
+MONGO_WAIT_QUEUE_TIMEOUT_MS = int(os.environ.get('MONGO_WAIT_QUEUE_TIMEOUT_MS', 2000))
+
+# uvicorn settings for `python asgi.py`
+HOST = os.environ.get('HOST', '0.0.0.0')
+PORT = int(os.environ.get('PORT', 8000))
+WEB_CONCURRENCY = int(os.environ.get('WEB_CONCURRENCY', os.cpu_count() or 1))
+
+templates = Jinja2Templates(directory=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates'))
+
+# The Motor client is created per worker process, on startup, inside its event loop,
+# along with the Motor variants of app.py's document cache and job queue
+mongo = {}
+
+
+def db():
+    return mongo['client'].get_default_database()
+
+
+# Rendered index page, keyed by the document's last_modified
+page_cache = web_common.PageCache()
+
+# Page views queue a scrape of the sources past their TTL, at most once per REFRESH_INTERVAL
+refresh_throttle = web_common.RefreshThrottle()
+
+
+async def index(request):
+    mars = await mongo['mars'].get()
+
+    # Serve what is stored right away, stale sources are refreshed in the background
+    await refresh_stale(mars)
+
+    # Show the progress of a scrape started from this page, this view is never cached
+    job_id = request.query_params.get('job')
+    job = await mongo['jobs'].follow(job_id) if job_id else None
+    if job is not None:
+        return templates.TemplateResponse(request, 'index.html', {'mars': mars, 'job': job})
+
+    last_modified = mars.get('last_modified') if mars else None
+    etag = f'"{last_modified.isoformat()}"' if last_modified else None
+    if etag and request.headers.get('if-none-match') == etag:
+        return Response(status_code=304, headers={'ETag': etag})
+
+    html = page_cache.get(last_modified, lambda: templates.get_template('index.html').render(
+        mars=mars, job=None, url_for=request.url_for))
+
+    headers = {'Cache-Control': 'no-cache'}
+    if etag:
+        headers['ETag'] = etag
+    return HTMLResponse(html, headers=headers)
+
+
+async def refresh_stale(mars):
+    stale = refresh_throttle.stale(mars)
+    if stale:
+        await submit(stale)
+
+
+async def submit(sources=None):
+
+    # Queue a scrape for worker.py, joining the one in flight if it covers `sources`
+    return await mongo['jobs'].submit(sources)
+
+
+async def scrape(request):
+    job = await submit()
+    if 'application/json' in request.headers.get('accept', ''):
+        return JSONResponse(job.to_dict(), status_code=202)
+    return RedirectResponse(f'/?job={job.id}', status_code=302)
+
+
+async def scrape_status(request):
+    job = await mongo['jobs'].get(request.path_params['job_id'])
+    if job is None:
+        raise HTTPException(404)
+    return JSONResponse(job.to_dict())
+
+
+async def image(request):
+
+    # Mirrored images are content addressed, so they can be cached forever
+    root = os.path.abspath(image_store.IMAGE_DIR)
+    path = os.path.abspath(os.path.join(root, request.path_params['name']))
+    if not path.startswith(root + os.sep) or not os.path.isfile(path):
+        raise HTTPException(404)
+    return FileResponse(path, headers={'Cache-Control': 'public, max-age=31536000, immutable'})
+
+
+async def api_mars(request):
+
+    # The scraped mars document as JSON, `?fields=a,b` selects fields
+    try:
+        fields = web_common.api_fields(request.query_params.get('fields'))
+    except ValueError:
+        raise HTTPException(400)
+
+    mars = await mongo['mars'].get() or {}
+    body, encoding, etag = web_common.api_mars(mars, fields, request.headers.get('accept-encoding'))
+    headers = {'ETag': f'"{etag}"', 'Cache-Control': 'no-cache', 'Vary': 'Accept-Encoding'}
+    if mars.get('last_modified') is not None:
+        headers['Last-Modified'] = mars['last_modified'].strftime('%a, %d %b %Y %H:%M:%S GMT')
+    if request.headers.get('if-none-match') == headers['ETag']:
+        return Response(status_code=304, headers=headers)
+    if encoding:
+        headers['Content-Encoding'] = encoding
+    return Response(web_common.compress(body, encoding), media_type='application/json', headers=headers)
+
+
+async def api_mars_history(request):
+
+    # Snapshot history as NDJSON, one change per line, streamed from the cursor
+    try:
+        start, end = web_common.history_range(request.query_params)
+    except ValueError:
+        raise HTTPException(400)
+    changes = mars_store.history(db(), start, end, request.query_params.get('source'))
+    gzipped = 'gzip' in web_common.accepted_encodings(request.headers.get('accept-encoding'))
+
+    async def lines():
+        encoder = web_common.NdjsonEncoder(gzipped)
+        async for change in changes:
+            chunk = encoder.encode(change)
+            if chunk:
+                yield chunk
+        tail = encoder.flush()
+        if tail:
+            yield tail
+
+    headers = {'Vary': 'Accept-Encoding'}
+    if gzipped:
+        headers['Content-Encoding'] = 'gzip'
+    return StreamingResponse(lines(), media_type='application/x-ndjson', headers=headers)
+
+
+async def api_news(request):
+
+    # Cursor-paginated news archive, newest first
+    try:
+        query, sort, limit = mars_store.news_query(
+            request.query_params.get('cursor'), int(request.query_params.get('limit', 20)))
+    except ValueError:
+        raise HTTPException(400)
+    articles = await db().news.find(query).sort(sort).limit(limit).to_list(limit)
+    return Response(web_common.to_json(web_common.news_body(articles, limit)), media_type='application/json')
+
+
+async def metrics_endpoint(request):
+    return Response(metrics.render(), media_type=metrics.CONTENT_TYPE)
+
+
+async def startup():
+    mongo['client'] = AsyncIOMotorClient(
+        MONGO_URI,
+        maxPoolSize=MONGO_MAX_POOL_SIZE,
+        minPoolSize=MONGO_MIN_POOL_SIZE,
+        maxIdleTimeMS=MONGO_MAX_IDLE_TIME_MS,
+        waitQueueTimeoutMS=MONGO_WAIT_QUEUE_TIMEOUT_MS)
+    mongo['mars'] = AsyncDocumentCache(db().mars)
+    mongo['jobs'] = AsyncJobQueue(db().scrape_jobs, total=len(mars_store.SOURCES))
+
+
+async def shutdown():
+    mongo.pop('mars').stop()
+    mongo.pop('jobs')
+    mongo.pop('client').close()
+
+
+app = Starlette(
+    routes=[
+        Route('/', index, name='index'),
+        Route('/scrape', scrape, name='scrape'),
+        Route('/scrape/{job_id}', scrape_status, name='scrape_status'),
+        Route('/images/{name:path}', image, name='image'),
+        Route('/api/mars', api_mars, name='api_mars'),
+        Route('/api/mars/history.ndjson', api_mars_history, name='api_mars_history'),
+        Route('/api/news', api_news, name='api_news'),
+        Route('/metrics', metrics_endpoint, name='metrics'),
+    ],
+    on_startup=[startup],
+    on_shutdown=[shutdown])
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    # One event loop per worker process, uvloop and httptools are used when installed
+    uvicorn.run('asgi:app', host=HOST, port=PORT, workers=WEB_CONCURRENCY, proxy_headers=True)
@@ -0,0 +1,107 @@
+# Scrape many targets that share the Mars page layouts and bulk upsert the results
+#
+#   python batch.py targets.json
+#
+# targets.json is a list of targets, each with a name and the URL of any sources
+# it has, e.g.
+#   [{"name": "mars-mirror", "news": "https://...", "facts": "https://..."}]
+import argparse
+import datetime as dt
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pymongo import ASCENDING, MongoClient, UpdateOne
+import scraping
+
+
+# Most (target, source) scrapes running at the same time; requests to one host are
+# further limited by scraping.HOST_CONCURRENCY
+BATCH_CONCURRENCY = int(os.environ.get('MARS_BATCH_CONCURRENCY', 8))
+
+
+# The extractors of scraping.py, called with a target's URL for that source
+def _news(browser, url):
+    news_title, news_paragraph = scraping.mars_news(browser, url)
+    return {"news_title": news_title, "news_paragraph": news_paragraph}
+
+def _featured_image(browser, url):
+    return {"featured_image": scraping.featured_image(browser, url)}
+
+def _facts(browser, url):
+    return {"facts": scraping.mars_facts(url)}
+
+def _hemispheres(browser, url):
+    return {"hemisphere_image_urls": scraping.hemispheres_images(browser, url)}
+
+EXTRACTORS = {
+    'news': _news,
+    'featured_image': _featured_image,
+    'facts': _facts,
+    'hemispheres': _hemispheres,
+}
+
+
+def load_targets(path):
+    with open(path) as f:
+        targets = json.load(f)
+    for target in targets:
+        if 'name' not in target:
+            raise ValueError(f'target without a name: {target!r}')
+    return targets
+
+
+def scrape_targets(targets, concurrency=BATCH_CONCURRENCY):
+
+    # Every (target, source) pair is its own task, so one slow host doesn't hold up
+    # the other targets. Results are grouped back per target
+    browser = scraping.BrowserSession()
+    results = {target['name']: {'target': target['name']} for target in targets}
+    tasks = [
+        (target['name'], source, target[source])
+        for target in targets for source in EXTRACTORS if target.get(source)
+    ]
+
+    def run(task):
+        name, source, url = task
+        try:
+            return name, EXTRACTORS[source](browser, url)
+        except Exception:
+            scraping.failed(source, 'batch')
+            return name, dict(scraping.EMPTY_RESULTS[source])
+
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            for name, data in executor.map(run, tasks):
+                results[name].update(data)
+    finally:
+        browser.quit()
+
+    now = dt.datetime.now()
+    for data in results.values():
+        data['last_modified'] = now
+    return list(results.values())
+
+
+def save_targets(db, results):
+
+    # One unordered bulk_write of upserts keyed by target name
+    db.targets.create_index([('target', ASCENDING)], unique=True)
+    if not results:
+        return None
+    return db.targets.bulk_write([
+        UpdateOne({'target': data['target']}, {'$set': data}, upsert=True)
+        for data in results
+    ], ordered=False)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Scrape a list of targets in one batch')
+    parser.add_argument('targets', help='JSON file with the list of targets')
+    parser.add_argument('--concurrency', type=int, default=BATCH_CONCURRENCY)
+    args = parser.parse_args()
+
+    db = MongoClient(os.environ.get('MONGO_URI', 'mongodb://localhost:27017/mars_app')).get_default_database()
+    results = scrape_targets(load_targets(args.targets), args.concurrency)
+    save_targets(db, results)
+    print(f'{len(results)} targets written')
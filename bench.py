@@ -0,0 +1,115 @@
+# Benchmark the scrapers and the index route offline, against the replayed fixtures
+import argparse
+import os
+import shutil
+import statistics
+import tempfile
+import time
+import tracemalloc
+import replay
+import scraping
+
+
+# Scraper stages, run over plain HTTP against the replay server
+STAGES = {
+    'mars_news': scraping.mars_news,
+    'featured_image': scraping.featured_image,
+    'mars_facts': scraping.mars_facts,
+    'hemispheres_images': scraping.hemispheres_images,
+}
+
+
+def percentile(values, p):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(p / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def measure(fn, runs, before=None):
+
+    # Wall time of every run, the peak traced allocation, and runs per second
+    timings = []
+    peak = 0
+    tracemalloc.start()
+    try:
+        for _ in range(runs):
+            if before is not None:
+                before()
+            tracemalloc.reset_peak()
+            started = time.perf_counter()
+            fn()
+            timings.append(time.perf_counter() - started)
+            peak = max(peak, tracemalloc.get_traced_memory()[1])
+    finally:
+        tracemalloc.stop()
+    return {
+        'runs': runs,
+        'p50': percentile(timings, 50),
+        'p90': percentile(timings, 90),
+        'p99': percentile(timings, 99),
+        'mean': statistics.mean(timings),
+        'peak_kib': peak / 1024,
+        'throughput': runs / sum(timings),
+    }
+
+
+def bench_scrapers(runs, warm_cache=False):
+
+    # A cold run starts every scrape with an empty HTTP cache
+    cache_root = tempfile.mkdtemp(prefix='mars-bench-cache-')
+    scraping.cache.directory = cache_root
+
+    def clear_cache():
+        shutil.rmtree(cache_root, ignore_errors=True)
+
+    results = {}
+    try:
+        for name, stage in STAGES.items():
+            results[name] = measure(stage, runs, before=None if warm_cache else clear_cache)
+    finally:
+        clear_cache()
+    return results
+
+
+def bench_index(runs):
+
+    # Needs a local mongod, the bench writes to its own database
+    os.environ.setdefault('MONGO_URI', 'mongodb://localhost:27017/mars_bench')
+    try:
+        import app as web
+        import mars_store
+        mars_store.save_scrape(web.mongo.db, scraping.scrape_all())
+    except Exception as e:
+        print(f'skipping index route: {e!r}')
+        return {}
+
+    client = web.app.test_client()
+    return {'index_route': measure(lambda: client.get('/'), runs)}
+
+
+def report(results):
+    print(f'{"stage":<20}{"runs":>6}{"p50 ms":>10}{"p90 ms":>10}{"p99 ms":>10}{"peak KiB":>11}{"ops/s":>10}')
+    for name, r in results.items():
+        print(f'{name:<20}{r["runs"]:>6}{r["p50"] * 1000:>10.2f}{r["p90"] * 1000:>10.2f}'
+              f'{r["p99"] * 1000:>10.2f}{r["peak_kib"]:>11.0f}{r["throughput"]:>10.1f}')
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Offline scrape benchmarks')
+    parser.add_argument('--runs', type=int, default=20)
+    parser.add_argument('--fixtures', default=replay.FIXTURE_DIR)
+    parser.add_argument('--latency', type=float, default=0, help='seconds added to every response')
+    parser.add_argument('--bandwidth', type=int, default=None, help='bytes per second per response')
+    parser.add_argument('--warm-cache', action='store_true', help='keep the HTTP cache between runs')
+    parser.add_argument('--skip-index', action='store_true', help="don't benchmark the Flask / route")
+    args = parser.parse_args()
+
+    server = replay.serve(args.fixtures, latency=args.latency, bandwidth=args.bandwidth)
+    replay.use_replay(server.base_url)
+
+    results = bench_scrapers(args.runs, args.warm_cache)
+    if not args.skip_index:
+        results.update(bench_index(args.runs))
+    report(results)
+    server.shutdown()
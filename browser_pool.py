@@ -0,0 +1,334 @@
+# Keep a few headless Chrome browsers running between scrapes
+import os
+import queue
+import threading
+import time
+from contextlib import contextmanager
+from splinter import Browser
+from webdriver_manager.chrome import ChromeDriverManager
+import metrics
+
+# psutil is optional, without it browsers are only recycled by use count and the
+# supervisor can't enforce limits or reap orphans
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+
+# Pool settings, overridable from the environment
+POOL_SIZE = int(os.environ.get('MARS_BROWSER_POOL_SIZE', 1))
+MAX_USES = int(os.environ.get('MARS_BROWSER_MAX_USES', 20))
+MAX_RSS_MB = int(os.environ.get('MARS_BROWSER_MAX_RSS_MB', 512))
+
+# Seconds a lease waits for a free browser before giving up
+LEASE_TIMEOUT = int(os.environ.get('MARS_BROWSER_LEASE_TIMEOUT', 60))
+
+# Supervisor limits: a leased browser over these is killed mid-scrape
+SESSION_MAX_RSS_MB = int(os.environ.get('MARS_BROWSER_SESSION_MAX_RSS_MB', 1024))
+SESSION_MAX_CPU_SECONDS = int(os.environ.get('MARS_BROWSER_SESSION_MAX_CPU_SECONDS', 120))
+
+# Seconds between supervisor checks, orphans are reaped every REAP_INTERVAL
+SUPERVISE_INTERVAL = int(os.environ.get('MARS_BROWSER_SUPERVISE_INTERVAL', 5))
+REAP_INTERVAL = int(os.environ.get('MARS_BROWSER_REAP_INTERVAL', 60))
+
+# Process names that belong to a browser session
+BROWSER_PROCESS_NAMES = ('chromedriver', 'chrome', 'chromium', 'google-chrome')
+
+
+# Resolve the chromedriver binary once per process instead of on every scrape
+_driver_path = None
+_driver_lock = threading.Lock()
+
+def driver_path():
+    global _driver_path
+    with _driver_lock:
+        if _driver_path is None:
+            _driver_path = ChromeDriverManager().install()
+        return _driver_path
+
+
+def launch_browser():
+    executable_path = {'executable_path': driver_path()}
+    with metrics.span('browser_launch', metrics.BROWSER_LAUNCH_SECONDS):
+        return Browser('chrome', **executable_path, headless=True)
+
+
+def driver_pid(browser):
+    try:
+        return browser.driver.service.process.pid
+    except AttributeError:
+        return None
+
+
+def process_tree(pid):
+
+    # chromedriver plus every Chrome process it started
+    if psutil is None or pid is None:
+        return []
+    try:
+        driver = psutil.Process(pid)
+        return [driver] + driver.children(recursive=True)
+    except psutil.Error:
+        return []
+
+
+def tree_usage(pid):
+
+    # Resident memory in MB and CPU seconds of a browser's process tree
+    rss = cpu = 0
+    for process in process_tree(pid):
+        try:
+            rss += process.memory_info().rss
+            times = process.cpu_times()
+            cpu += times.user + times.system
+        except psutil.Error:
+            continue
+    return rss / (1024 * 1024), cpu
+
+
+def browser_rss_mb(browser):
+    return tree_usage(driver_pid(browser))[0]
+
+
+def kill_tree(pid):
+    return kill_processes(process_tree(pid))
+
+
+def kill_processes(processes):
+
+    # Kill a chromedriver and its Chrome processes, children first
+    for process in reversed(processes):
+        try:
+            process.kill()
+        except psutil.Error:
+            pass
+    if processes:
+        psutil.wait_procs(processes, timeout=5)
+    return len(processes)
+
+
+def _is_browser_process(process):
+
+    # Any chromedriver, but only Chrome started headless or under remote control
+    try:
+        name = process.name().lower()
+        if name.startswith('chromedriver'):
+            return True
+        if not any(name.startswith(n) for n in BROWSER_PROCESS_NAMES):
+            return False
+        cmdline = ' '.join(process.cmdline())
+    except psutil.Error:
+        return False
+    return '--headless' in cmdline or '--remote-debugging' in cmdline
+
+
+def find_orphans(tracked_pids=()):
+
+    # chromedriver / Chrome trees of this user whose parent has died (re-parented
+    # to init) and that no pool of this process is tracking
+    if psutil is None:
+        return []
+    username = psutil.Process().username()
+    orphans = []
+    for process in psutil.process_iter(['pid', 'ppid', 'username']):
+        info = process.info
+        if info['username'] != username or info['pid'] in tracked_pids:
+            continue
+        if info['ppid'] == 1 and _is_browser_process(process):
+            orphans.append(info['pid'])
+    return orphans
+
+
+class LeaseTimeout(RuntimeError):
+    pass
+
+
+class PooledBrowser:
+
+    # A pooled browser, how many scrapes it has served and its usage at lease time
+
+    def __init__(self, browser):
+        self.browser = browser
+        self.pid = driver_pid(browser)
+        self.uses = 0
+        self.lease_cpu = 0
+        self.killed = None
+
+
+class BrowserPool:
+
+    def __init__(self, size=POOL_SIZE, max_uses=MAX_USES, max_rss_mb=MAX_RSS_MB,
+                 session_max_rss_mb=SESSION_MAX_RSS_MB, session_max_cpu=SESSION_MAX_CPU_SECONDS):
+        self.size = size
+        self.max_uses = max_uses
+        self.max_rss_mb = max_rss_mb
+        self.session_max_rss_mb = session_max_rss_mb
+        self.session_max_cpu = session_max_cpu
+        self.idle = queue.LifoQueue()
+        self.slots = threading.BoundedSemaphore(size)
+        self.lock = threading.Lock()
+        self.launched = 0
+        self.leased = set()
+        self.counts = {'leases': 0, 'recycled': 0, 'killed_rss': 0, 'killed_cpu': 0,
+                       'failed_sessions': 0, 'reaped': 0}
+        self.supervisor = None
+
+    def warm(self):
+
+        # Resolve the driver and start the browsers up front, at process start.
+        # Trees orphaned by a previous worker are reaped first, and the supervisor
+        # starts with the pool rather than on the first lease
+        self.reap()
+        self.start_supervisor()
+        driver_path()
+        with self.lock:
+            missing = self.size - self.launched
+            self.launched += missing
+        for _ in range(missing):
+            self.idle.put(PooledBrowser(launch_browser()))
+
+    @contextmanager
+    def lease(self, timeout=LEASE_TIMEOUT):
+
+        # Borrow a browser for one scrape, at most `size` are out at a time. A
+        # session that raises is torn down instead of going back to the pool
+        self.start_supervisor()
+        if not self.slots.acquire(timeout=timeout):
+            raise LeaseTimeout(f'no browser free after {timeout}s')
+        try:
+            pooled = self._checkout()
+            try:
+                yield pooled.browser
+            except BaseException:
+                with self.lock:
+                    self.leased.discard(pooled)
+                    self.counts['failed_sessions'] += 1
+                self._discard(pooled)
+                raise
+            else:
+                self._checkin(pooled)
+        finally:
+            self.slots.release()
+
+    def _checkout(self):
+        try:
+            pooled = self.idle.get_nowait()
+        except queue.Empty:
+            pooled = PooledBrowser(launch_browser())
+            with self.lock:
+                self.launched += 1
+        pooled.lease_cpu = tree_usage(pooled.pid)[1]
+        with self.lock:
+            self.leased.add(pooled)
+            self.counts['leases'] += 1
+        return pooled
+
+    def _checkin(self, pooled):
+
+        # Recycle the browser once it is worn out, otherwise reset it for the next lease
+        with self.lock:
+            self.leased.discard(pooled)
+        pooled.uses += 1
+        if (pooled.killed or pooled.uses >= self.max_uses
+                or browser_rss_mb(pooled.browser) > self.max_rss_mb):
+            with self.lock:
+                self.counts['recycled'] += 1
+            self._discard(pooled)
+            return
+        try:
+            pooled.browser.cookies.delete()
+            pooled.browser.visit('about:blank')
+        except Exception:
+            self._discard(pooled)
+            return
+        self.idle.put(pooled)
+
+    def _discard(self, pooled):
+
+        # Quit politely, then make sure nothing of the process tree is left behind
+        processes = process_tree(pooled.pid)
+        with self.lock:
+            self.launched -= 1
+        try:
+            pooled.browser.quit()
+        except Exception:
+            pass
+        kill_processes([p for p in processes if p.is_running()])
+
+    def start_supervisor(self):
+        with self.lock:
+            if self.supervisor is not None or psutil is None:
+                return
+            self.supervisor = threading.Thread(target=self._supervise, daemon=True)
+        self.supervisor.start()
+
+    def _supervise(self):
+
+        # Kill leased sessions over their RSS or CPU budget, the scrape using one
+        # fails and its lease discards it. Reap orphaned trees every REAP_INTERVAL
+        last_reap = 0
+        while True:
+            time.sleep(SUPERVISE_INTERVAL)
+            with self.lock:
+                leased = list(self.leased)
+            for pooled in leased:
+                rss, cpu = tree_usage(pooled.pid)
+                if rss > self.session_max_rss_mb:
+                    pooled.killed = 'killed_rss'
+                elif cpu - pooled.lease_cpu > self.session_max_cpu:
+                    pooled.killed = 'killed_cpu'
+                else:
+                    continue
+                with self.lock:
+                    self.counts[pooled.killed] += 1
+                kill_tree(pooled.pid)
+            if time.monotonic() - last_reap >= REAP_INTERVAL:
+                last_reap = time.monotonic()
+                self.reap()
+
+    def tracked_pids(self):
+        with self.lock:
+            pooled = list(self.leased) + list(self.idle.queue)
+        return {p.pid for browser in pooled for p in process_tree(browser.pid)}
+
+    def reap(self):
+
+        # Kill orphaned chromedriver / Chrome trees left by crashed scrapes or workers
+        reaped = 0
+        for pid in find_orphans(self.tracked_pids()):
+            reaped += kill_tree(pid)
+        with self.lock:
+            self.counts['reaped'] += reaped
+        return reaped
+
+    def stats(self):
+
+        # Pool counters plus the current memory and CPU use of every browser
+        with self.lock:
+            leased = list(self.leased)
+            counts = dict(self.counts)
+            launched = self.launched
+        idle = list(self.idle.queue)
+
+        def usage(pooled, state):
+            rss, cpu = tree_usage(pooled.pid)
+            return {'pid': pooled.pid, 'state': state, 'uses': pooled.uses,
+                    'rss_mb': round(rss, 1), 'cpu_seconds': round(cpu, 2)}
+
+        browsers = [usage(p, 'leased') for p in leased] + [usage(p, 'idle') for p in idle]
+        return dict(counts, size=self.size, launched=launched, leased=len(leased), idle=len(idle),
+                    rss_mb=round(sum(b['rss_mb'] for b in browsers), 1), browsers=browsers)
+
+    def close(self):
+
+        # Quit every idle browser
+        while True:
+            try:
+                self._discard(self.idle.get_nowait())
+            except queue.Empty:
+                break
+
+
+# Process wide pool used by the scrapers
+pool = BrowserPool()
@@ -0,0 +1,139 @@
+# Command line scrapes: stream each source's result as an NDJSON line
+#
+#   python cli.py                              all sources to stdout
+#   python cli.py -s news,facts -o out.ndjson  some sources, to a file
+#   python cli.py --replay fixtures            against recorded fixtures, see replay.py
+#   python cli.py --profile profiles           cProfile + tracemalloc report per stage
+import argparse
+import cProfile
+import datetime as dt
+import io
+import json
+import os
+import pstats
+import sys
+import time
+import tracemalloc
+import scraping
+
+
+def to_json(value):
+    def default(o):
+        if isinstance(o, dt.datetime):
+            return o.isoformat()
+        return str(o)
+    return json.dumps(value, default=default)
+
+
+class NDJSONWriter:
+
+    # One line per source, flushed right away so pipelines see it as soon as it completes
+
+    def __init__(self, out, started):
+        self.out = out
+        self.started = started
+
+    def write(self, source, data=None, error=None, **extra):
+        line = {'source': source, 'elapsed': round(time.perf_counter() - self.started, 4)}
+        if error is not None:
+            line['error'] = error
+        else:
+            line['data'] = data
+        line.update(extra)
+        self.out.write(to_json(line) + '\n')
+        self.out.flush()
+
+
+def run(sources, writer, use_browser):
+
+    # All selected sources at once, each line is written as its source finishes
+    reported = set()
+
+    def on_result(name, result):
+        reported.add(name)
+        writer.write(name, result)
+
+    scraping.scrape_all(sources=sources, on_result=on_result, use_browser=use_browser)
+    for name in sources:
+        if name not in reported:
+            writer.write(name, error='failed or missed its deadline')
+
+
+def run_profiled(sources, writer, use_browser, directory):
+
+    # One source at a time, so each stage gets its own cProfile and tracemalloc numbers
+    os.makedirs(directory, exist_ok=True)
+    for name in sources:
+        profile = cProfile.Profile()
+        tracemalloc.start()
+        started = time.perf_counter()
+        data, error = None, None
+        try:
+            profile.enable()
+            data = scraping.scrape_all(concurrent=False, sources=[name], use_browser=use_browser)
+        except Exception as e:
+            # Sequential scrapes re-raise, a failed source gets an error line and
+            # the other sources still run
+            error = f'{type(e).__name__}: {e}'
+        finally:
+            profile.disable()
+            elapsed = time.perf_counter() - started
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+        stats = {'seconds': round(elapsed, 4), 'peak_kib': round(peak / 1024, 1)}
+        if error is not None:
+            writer.write(name, error=error, profile=stats)
+        else:
+            data.pop('last_modified', None)
+            writer.write(name, data, profile=stats)
+
+        # Full stats for snakeviz/pstats, plus a short text report
+        profile.dump_stats(os.path.join(directory, f'{name}.prof'))
+        report = io.StringIO()
+        pstats.Stats(profile, stream=report).sort_stats('cumulative').print_stats(25)
+        report.write('\nTop allocations\n')
+        for stat in snapshot.statistics('lineno')[:15]:
+            report.write(f'{stat}\n')
+        with open(os.path.join(directory, f'{name}.txt'), 'w') as f:
+            f.write(report.getvalue())
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Scrape the Mars sources and stream NDJSON')
+    parser.add_argument('-s', '--sources', default=','.join(scraping.SOURCES),
+                        help=f'comma separated, from {", ".join(scraping.SOURCES)}')
+    parser.add_argument('-o', '--output', default='-', help='file to write, - for stdout')
+    parser.add_argument('--no-browser', action='store_true', help="never fall back to Chrome")
+    parser.add_argument('--replay', metavar='DIR', help='scrape recorded fixtures instead of the live sites')
+    parser.add_argument('--profile', metavar='DIR', help='write cProfile/tracemalloc reports per stage to DIR')
+    args = parser.parse_args(argv)
+
+    sources = [s for s in args.sources.split(',') if s]
+    unknown = [s for s in sources if s not in scraping.SOURCES]
+    if unknown:
+        parser.error(f'unknown sources: {", ".join(unknown)}')
+
+    server = None
+    if args.replay:
+        import replay
+        server = replay.serve(args.replay)
+        replay.use_replay(server.base_url)
+
+    out = sys.stdout if args.output == '-' else open(args.output, 'w')
+    try:
+        writer = NDJSONWriter(out, time.perf_counter())
+        if args.profile:
+            run_profiled(sources, writer, not args.no_browser, args.profile)
+        else:
+            run(sources, writer, not args.no_browser)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+        if server is not None:
+            server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
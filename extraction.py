@@ -0,0 +1,118 @@
+# Declarative extraction specs, compiled once into single-pass extractors
+#
+# Each source in extraction.json lists its fields. A field has a CSS selector
+# (`select`) and takes either an attribute (`attr`) or the element text (`text`).
+# Optional keys:
+#   join         resolve the value against the page URL
+#   many         collect every match instead of the first one
+#   unique       drop repeated values of a `many` field
+#   text_equals  only match elements whose text is exactly this
+#   has          only match elements containing an element matching this selector
+# A source `scope` restricts all of its fields to the first element matching it.
+#
+# Pages are parsed with the html_parser backend (selectolax or lxml when installed).
+# The field selectors are joined into one selector group, so the document is walked
+# once and each match is handed to the fields it satisfies
+import hashlib
+import json
+import os
+import re
+from urllib.parse import urljoin
+import html_parser
+
+
+SPECS_PATH = os.environ.get(
+    'MARS_EXTRACTION_SPECS',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'extraction.json'))
+
+# A selector the BeautifulSoup backends can strain on: 'tag' or 'tag.class'
+_STRAINABLE = re.compile(r'^[\w-]+(\.[\w-]+)?$')
+
+
+class Field:
+
+    def __init__(self, name, spec):
+        self.name = name
+        self.select = spec['select']
+        self.attr = spec.get('attr')
+        self.text_equals = spec.get('text_equals')
+        self.has = spec.get('has')
+        self.join = spec.get('join', False)
+        self.many = spec.get('many', False)
+        self.unique = spec.get('unique', False)
+
+    def value(self, node, base_url):
+
+        # The field's value for a matched node, None when the node doesn't qualify
+        if self.has is not None and node.select_one(self.has) is None:
+            return None
+        if self.text_equals is not None and ' '.join(node.text().split()) != self.text_equals:
+            return None
+        value = node.attr(self.attr) if self.attr else ' '.join(node.text().split())
+        if value is not None and self.join and base_url:
+            value = urljoin(base_url, value)
+        return value
+
+
+class Extractor:
+
+    def __init__(self, spec):
+        self.scope = spec.get('scope')
+        self.fields = [Field(name, field) for name, field in spec['fields'].items()]
+        self.group = ', '.join(dict.fromkeys(field.select for field in self.fields))
+        self.only = _only(self.scope, self.fields)
+
+        # Identifies the spec, results cached from an older one are not reused
+        self.version = hashlib.sha1(json.dumps(spec, sort_keys=True).encode('utf-8')).hexdigest()[:12]
+
+    def extract(self, html, base_url=None):
+
+        # Every field of the spec from one pass over the matches of the selector group
+        results = {field.name: [] if field.many else None for field in self.fields}
+        doc = html_parser.parse(html, only=self.only)
+        root = doc.select_one(self.scope) if self.scope else doc
+        if root is None:
+            return results
+
+        for node in root.select(self.group):
+            for field in self.fields:
+                if not field.many and results[field.name] is not None:
+                    continue
+                if not node.matches(field.select):
+                    continue
+                value = field.value(node, base_url)
+                if value is None:
+                    continue
+                if not field.many:
+                    results[field.name] = value
+                elif not (field.unique and value in results[field.name]):
+                    results[field.name].append(value)
+        return results
+
+
+def _only(scope, fields):
+
+    # Subtrees the BeautifulSoup backends need to build: the scope, or the outermost
+    # tag of every field selector. None builds the whole document
+    if scope:
+        return scope if _STRAINABLE.match(scope) else None
+    tags = set()
+    for field in fields:
+        outer = field.select.split()[0]
+        if ',' in field.select or not _STRAINABLE.match(outer):
+            return None
+        tags.add(outer.partition('.')[0])
+    return tuple(sorted(tags))
+
+
+def load_specs(path=SPECS_PATH):
+    with open(path) as f:
+        return json.load(f)
+
+
+def compile_specs(specs):
+    return {source: Extractor(spec) for source, spec in specs.items()}
+
+
+# Compiled once, when the module is imported
+EXTRACTORS = compile_specs(load_specs())
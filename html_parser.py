@@ -0,0 +1,105 @@
+# Pluggable HTML parser backends for the extraction specs and the news archive
+import os
+import soupsieve
+from bs4 import BeautifulSoup, SoupStrainer
+from bs4.element import Tag
+
+# selectolax and lxml are optional, the fastest one installed is used by default
+try:
+    from selectolax.parser import HTMLParser as SelectolaxParser
+except ImportError:
+    SelectolaxParser = None
+
+try:
+    import lxml
+except ImportError:
+    lxml = None
+
+
+BACKENDS = ('selectolax', 'lxml', 'html.parser')
+
+
+def default_backend():
+    if SelectolaxParser is not None:
+        return 'selectolax'
+    if lxml is not None:
+        return 'lxml'
+    return 'html.parser'
+
+
+# Backend used when `parse` isn't given one, overridable from the environment
+BACKEND = os.environ.get('MARS_HTML_PARSER') or default_backend()
+
+
+class Node:
+
+    # The few operations the scrapers need, on top of a BeautifulSoup tag or a
+    # selectolax node. Missing elements come back as None, so chained lookups
+    # raise AttributeError just like the plain soup calls did
+
+    def __init__(self, node):
+        self.node = node
+
+    @classmethod
+    def wrap(cls, node):
+        return None if node is None else cls(node)
+
+    def select_one(self, css):
+        if isinstance(self.node, Tag):
+            return Node.wrap(self.node.select_one(css))
+        return Node.wrap(self.node.css_first(css))
+
+    def select(self, css):
+        if isinstance(self.node, Tag):
+            return [Node(n) for n in self.node.select(css)]
+        return [Node(n) for n in self.node.css(css)]
+
+    def text(self):
+        if isinstance(self.node, Tag):
+            return self.node.get_text()
+        return self.node.text()
+
+    def attr(self, name):
+        if isinstance(self.node, Tag):
+            return self.node.get(name)
+        return self.node.attributes.get(name)
+
+    def matches(self, css):
+        if isinstance(self.node, Tag):
+            return soupsieve.match(css, self.node)
+        return self.node.css_matches(css)
+
+    def find_text(self, css, text):
+
+        # First element matching `css` whose text is exactly `text`
+        for node in self.select(css):
+            if node.text().strip() == text:
+                return node
+        return None
+
+
+def _strainer(only):
+
+    # `only` is 'tag', 'tag.class' or a tuple of tag names
+    if isinstance(only, (tuple, list)):
+        return SoupStrainer(list(only))
+    tag, _, cls = only.partition('.')
+    return SoupStrainer(tag, class_=cls) if cls else SoupStrainer(tag)
+
+
+def parse(html, only=None, backend=None):
+
+    # Parse a page with the selected backend. With `only`, the BeautifulSoup
+    # backends build just the matching subtrees instead of the whole document;
+    # selectolax parses everything anyway, it is faster than building the strainer
+    backend = backend or BACKEND
+    if backend == 'selectolax' and SelectolaxParser is not None:
+        return Node(SelectolaxParser(html))
+
+    # Fall back to the best BeautifulSoup builder that is installed
+    if backend != 'html.parser' and lxml is None:
+        backend = 'html.parser'
+    elif backend == 'selectolax':
+        backend = 'lxml'
+    parse_only = _strainer(only) if only else None
+    return Node(BeautifulSoup(html, backend, parse_only=parse_only))
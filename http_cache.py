@@ -0,0 +1,88 @@
+# On-disk cache of source pages and the fields extracted from them
+import hashlib
+import json
+import os
+import tempfile
+import metrics
+
+
+# Where cache entries are stored, one JSON file per URL
+CACHE_DIR = os.environ.get('MARS_HTTP_CACHE_DIR', '.http_cache')
+
+
+class HTTPCache:
+
+    # Sends conditional requests using the stored ETag / Last-Modified and skips
+    # parsing when the page comes back 304 or its body hash has not changed
+
+    def __init__(self, session, directory=CACHE_DIR):
+        self.session = session
+        self.directory = directory
+
+    def _path(self, url):
+        key = hashlib.sha256(url.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, f'{key}.json')
+
+    def load(self, url):
+        try:
+            with open(self._path(url)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def save(self, url, entry):
+
+        # Write to a temporary file first so readers never see a half written entry
+        os.makedirs(self.directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(entry, f)
+        os.replace(tmp_path, self._path(url))
+
+    def extract(self, url, name, parse, timeout=None, version=None):
+
+        # Return parse(html) for the page, reusing the stored result under `name`
+        # when the page is unchanged. A result stored by another `version` of the
+        # parser doesn't count, so changing the parser re-parses unchanged pages
+        entry = self.load(url)
+        fields = entry.get('fields', {})
+        key = f'{name}@{version}' if version else name
+
+        headers = {}
+        if key in fields:
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+
+        with metrics.span('fetch', metrics.SCRAPE_STAGE_SECONDS, source=name, stage='fetch'):
+            response = self.session.get(url, headers=headers, timeout=timeout)
+        if response.status_code == 304 and key in fields:
+            metrics.cache_result('http', True)
+            return fields[key]
+        response.raise_for_status()
+
+        body_hash = hashlib.sha256(response.content).hexdigest()
+        metrics.cache_result('http', entry.get('hash') == body_hash and key in fields)
+        if entry.get('hash') == body_hash and key in fields:
+            result = fields[key]
+        else:
+            with metrics.span('parse', metrics.SCRAPE_STAGE_SECONDS, source=name, stage='parse'):
+                result = parse(response.text)
+            if entry.get('hash') != body_hash:
+                fields = {}
+            # Missing selectors are not cached so the caller can fall back to the browser
+            if result is None:
+                return None
+            # Results of older versions of this parser are dropped
+            fields = {k: v for k, v in fields.items() if k.partition('@')[0] != name}
+            fields[key] = result
+
+        self.save(url, {
+            'url': url,
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+            'hash': body_hash,
+            'fields': fields
+        })
+        return result
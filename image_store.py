@@ -0,0 +1,140 @@
+# Mirror scraped images into a local content-addressed store with resized variants
+import hashlib
+import mimetypes
+import os
+import posixpath
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from urllib.parse import urlparse
+
+
+# Where mirrored images and their variants are written
+IMAGE_DIR = os.environ.get('MARS_IMAGE_DIR', 'image_store')
+
+# Widths of the resized variants, in pixels
+VARIANT_WIDTHS = (320, 640, 1280)
+
+# Most images downloaded at the same time
+DOWNLOAD_CONCURRENCY = 4
+
+
+def download(session, url, cache=None, timeout=30):
+
+    # Save an image under the hash of its content, skipping the write if it is already
+    # stored. With an HTTPCache, a URL mirrored before is only fetched again through a
+    # conditional GET, or not at all when the server sent no validators
+    entry = cache.load(url) if cache is not None else {}
+    stored = entry.get('image')
+    headers = {}
+    if stored and os.path.exists(os.path.join(IMAGE_DIR, stored)):
+        if not entry.get('etag') and not entry.get('last_modified'):
+            return stored
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+
+    response = session.get(url, headers=headers, timeout=timeout)
+    if response.status_code == 304 and headers:
+        return stored
+    response.raise_for_status()
+    digest = hashlib.sha256(response.content).hexdigest()
+
+    ext = posixpath.splitext(urlparse(url).path)[1].lower()
+    if not ext:
+        ext = mimetypes.guess_extension(response.headers.get('Content-Type', '').split(';')[0]) or '.jpg'
+    name = f'{digest}{ext}'
+
+    path = os.path.join(IMAGE_DIR, name)
+    if not os.path.exists(path):
+        os.makedirs(IMAGE_DIR, exist_ok=True)
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(response.content)
+        os.replace(tmp_path, path)
+
+    if cache is not None:
+        cache.save(url, {
+            'url': url,
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+            'image': name
+        })
+    return name
+
+
+def make_variants(name):
+
+    # Resize one stored image to every variant width as JPEG and WebP. Runs in a
+    # worker process, so Pillow is only imported there
+    from PIL import Image
+
+    digest = os.path.splitext(name)[0]
+    variants = {'original': name, 'jpeg': [], 'webp': []}
+
+    # Opening only reads the header, the pixels are only decoded when a variant is missing
+    with Image.open(os.path.join(IMAGE_DIR, name)) as original:
+        original_width, original_height = original.size
+
+        # Never upscale, a small original gets a single variant at its own width
+        widths = sorted({w for w in VARIANT_WIDTHS if w < original_width} | {min(original_width, VARIANT_WIDTHS[-1])})
+        formats = (('jpeg', 'jpg'), ('webp', 'webp'))
+        complete = all(
+            os.path.exists(os.path.join(IMAGE_DIR, f'{digest}-{width}.{ext}'))
+            for width in widths for _, ext in formats)
+        image = None if complete else original.convert('RGB')
+
+    for width in widths:
+        resized = None
+        for fmt, ext in formats:
+            variant = f'{digest}-{width}.{ext}'
+            path = os.path.join(IMAGE_DIR, variant)
+            if not os.path.exists(path):
+                if resized is None:
+                    height = max(1, round(original_height * width / original_width))
+                    resized = image.resize((width, height), Image.LANCZOS)
+                resized.save(path, fmt.upper(), quality=82)
+            variants[fmt].append({'name': variant, 'width': width})
+
+    return variants
+
+
+def mirror_images(data, session, cache=None):
+
+    # Download the featured and hemisphere images once and attach their local variants
+    urls = []
+    if data.get('featured_image'):
+        urls.append(data['featured_image'])
+    for hemisphere in data.get('hemisphere_image_urls') or []:
+        urls.append(hemisphere['img_url'])
+    if not urls:
+        return data
+
+    def fetch(url):
+        try:
+            return download(session, url, cache)
+        except Exception:
+            return None
+
+    with ThreadPoolExecutor(max_workers=DOWNLOAD_CONCURRENCY) as executor:
+        names = dict(zip(urls, executor.map(fetch, urls)))
+
+    # Resizing is CPU bound, so it runs in a process pool. An image that fails to
+    # resize (corrupt file, dead worker) keeps no variants instead of failing the save
+    stored = sorted({name for name in names.values() if name})
+    variants = {}
+    with ProcessPoolExecutor() as executor:
+        futures = {name: executor.submit(make_variants, name) for name in stored}
+        for name, future in futures.items():
+            try:
+                variants[name] = future.result()
+            except Exception:
+                variants[name] = None
+
+    def variants_for(url):
+        return variants.get(names.get(url))
+
+    if data.get('featured_image'):
+        data['featured_image_variants'] = variants_for(data['featured_image'])
+    for hemisphere in data.get('hemisphere_image_urls') or []:
+        hemisphere['variants'] = variants_for(hemisphere['img_url'])
+    return data
@@ -0,0 +1,258 @@
+# Scrape jobs queued in a Mongo collection and run by worker.py, with at most one
+# scrape in flight at a time
+import datetime as dt
+import uuid
+from pymongo import ASCENDING, ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+
+# Finished jobs are removed after a week
+KEEP_SECONDS = 7 * 24 * 3600
+
+
+def new_job(total, sources=None):
+
+    # `sources` limits the scrape to some sources, None scrapes them all
+    return {
+        '_id': uuid.uuid4().hex,
+        'status': 'queued',
+        'sources': list(sources) if sources else None,
+        'total': len(sources) if sources else total,
+        'completed': [],
+        'error': None,
+        'created': dt.datetime.now(),
+        'inflight': True
+    }
+
+
+def covers(job_sources, sources):
+
+    # Whether a job scraping `job_sources` also scrapes `sources`, None means all
+    if job_sources is None:
+        return True
+    return sources is not None and set(sources) <= set(job_sources)
+
+
+def merge_sources(job_sources, sources):
+    if job_sources is None or sources is None:
+        return None
+    return sorted(set(job_sources) | set(sources))
+
+
+class ScrapeJob:
+
+    def __init__(self, document):
+        self.document = document
+
+    @property
+    def id(self):
+        return self.document['_id']
+
+    @property
+    def status(self):
+        return self.document['status']
+
+    @property
+    def sources(self):
+        return self.document.get('sources')
+
+    @property
+    def total(self):
+        return self.document['total']
+
+    @property
+    def completed(self):
+        return self.document.get('completed', [])
+
+    @property
+    def error(self):
+        return self.document.get('error')
+
+    @property
+    def next(self):
+        return self.document.get('next')
+
+    @property
+    def active(self):
+
+        # Also while the sources requested during the run are being handed to `next`
+        followup = self.document.get('followup') or self.document.get('followup_all')
+        return self.status in ('queued', 'running') or bool(followup and not self.next)
+
+    def to_dict(self):
+        def iso(value):
+            return value.isoformat() if value else None
+        return {
+            'id': self.id,
+            'status': self.status,
+            'sources': self.sources,
+            'progress': {'completed': list(self.completed), 'total': self.total},
+            'error': self.error,
+            'next': self.next,
+            'created': iso(self.document.get('created')),
+            'started': iso(self.document.get('started')),
+            'finished': iso(self.document.get('finished'))
+        }
+
+
+def run(ops, collection):
+
+    # Carry out the collection calls an operation generator yields, sending back
+    # each result (or throwing its exception) until it returns
+    result, error = None, None
+    while True:
+        try:
+            method, args, kwargs = ops.throw(error) if error else ops.send(result)
+        except StopIteration as stop:
+            return stop.value
+        try:
+            result, error = getattr(collection, method)(*args, **kwargs), None
+        except Exception as e:
+            result, error = None, e
+
+
+async def run_async(ops, collection):
+
+    # `run` for Motor, whose collection calls are awaited
+    result, error = None, None
+    while True:
+        try:
+            method, args, kwargs = ops.throw(error) if error else ops.send(result)
+        except StopIteration as stop:
+            return stop.value
+        try:
+            result, error = await getattr(collection, method)(*args, **kwargs), None
+        except Exception as e:
+            result, error = None, e
+
+
+def call(method, *args, **kwargs):
+    return method, args, kwargs
+
+
+class JobQueue:
+
+    # Concurrent submits join the job already in flight instead of queueing another
+    # scrape, as long as it covers the sources they asked for. The in-flight job
+    # carries `inflight: True`, which a unique partial index allows on only one document
+
+    # The web side is written as generators of collection calls, so the same logic
+    # runs on pymongo here and on Motor in AsyncJobQueue
+
+    def __init__(self, collection, total):
+        self.collection = collection
+        self.total = total
+
+    def ensure_indexes(self):
+        self.collection.create_index(
+            'inflight', unique=True, partialFilterExpression={'inflight': True})
+        self.collection.create_index([('status', ASCENDING), ('created', ASCENDING)])
+        self.collection.create_index('finished', expireAfterSeconds=KEEP_SECONDS)
+
+    def submit(self, sources=None):
+        return run(self._submit(sources), self.collection)
+
+    def get(self, job_id):
+        return run(self._get(job_id), self.collection)
+
+    def follow(self, job_id):
+        return run(self._follow(job_id), self.collection)
+
+    def _submit(self, sources):
+
+        # Join the job in flight when it already covers `sources`. A job that is
+        # still queued takes the missing sources on board, a running one records
+        # them as a follow-up that `finish` queues once it is done
+        job = new_job(self.total, sources)
+        while True:
+            try:
+                document = yield call(
+                    'find_one_and_update', {'inflight': True}, {'$setOnInsert': job},
+                    upsert=True, return_document=ReturnDocument.AFTER)
+            except DuplicateKeyError:
+                # Another request queued the job first, join it
+                document = yield call('find_one', {'inflight': True})
+                if document is None:
+                    continue
+            if covers(document.get('sources'), sources):
+                return ScrapeJob(document)
+            if document['status'] == 'queued':
+                merged = merge_sources(document.get('sources'), sources)
+                update = {'$set': {'sources': merged, 'total': len(merged) if merged else self.total}}
+                document = yield call(
+                    'find_one_and_update',
+                    {'_id': document['_id'], 'status': 'queued', 'sources': document.get('sources')},
+                    update, return_document=ReturnDocument.AFTER)
+            else:
+                update = {'$set': {'followup_all': True}} if sources is None else \
+                    {'$addToSet': {'followup': {'$each': list(sources)}}}
+                document = yield call(
+                    'find_one_and_update', {'_id': document['_id'], 'inflight': True}, update,
+                    return_document=ReturnDocument.AFTER)
+            # Retry when the job was claimed or finished in the meantime
+            if document is not None:
+                return ScrapeJob(document)
+
+    def _get(self, job_id):
+        document = yield call('find_one', {'_id': job_id})
+        return ScrapeJob(document) if document else None
+
+    def _follow(self, job_id):
+
+        # The job a page is waiting on: once it is done, the follow-up that scrapes
+        # the sources requested while it ran
+        job = yield from self._get(job_id)
+        while job is not None and not job.active and job.next:
+            job = yield from self._get(job.next)
+        return job
+
+    # Worker side
+
+    def claim(self):
+
+        # Take the oldest queued job, returns None when there is nothing to do
+        document = self.collection.find_one_and_update(
+            {'status': 'queued'},
+            {'$set': {'status': 'running', 'started': dt.datetime.now()}},
+            sort=[('created', ASCENDING)], return_document=ReturnDocument.AFTER)
+        return ScrapeJob(document) if document else None
+
+    def source_done(self, job, name):
+        self.collection.update_one({'_id': job.id}, {'$push': {'completed': name}})
+
+    def finish(self, job, error=None):
+        document = self.collection.find_one_and_update({'_id': job.id}, {
+            '$set': {
+                'status': 'failed' if error else 'done',
+                'error': error,
+                'finished': dt.datetime.now()
+            },
+            '$unset': {'inflight': ''}
+        }, return_document=ReturnDocument.AFTER)
+
+        # Queue the sources requested while this job was running
+        if document and (document.get('followup_all') or document.get('followup')):
+            followup = self.submit(None if document.get('followup_all') else document['followup'])
+            self.collection.update_one({'_id': job.id}, {'$set': {'next': followup.id}})
+
+    def fail_stale(self, timeout):
+
+        # Give up on jobs whose worker died mid-scrape so new scrapes can be queued,
+        # their follow-ups are queued like those of any finished job
+        cutoff = dt.datetime.now() - dt.timedelta(seconds=timeout)
+        for document in self.collection.find({'status': 'running', 'started': {'$lt': cutoff}}):
+            self.finish(ScrapeJob(document), error='timed out')
+
+
+class AsyncJobQueue(JobQueue):
+
+    # The web side of JobQueue on a Motor collection, for asgi.py
+
+    async def submit(self, sources=None):
+        return await run_async(self._submit(sources), self.collection)
+
+    async def get(self, job_id):
+        return await run_async(self._get(job_id), self.collection)
+
+    async def follow(self, job_id):
+        return await run_async(self._follow(job_id), self.collection)
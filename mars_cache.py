@@ -0,0 +1,170 @@
+# Read-through cache of the mars document, invalidated by a change stream
+import asyncio
+import threading
+import time
+from pymongo.errors import PyMongoError
+import metrics
+
+
+# Fields the index page needs from the mars document
+INDEX_PROJECTION = {
+    'news_title': True,
+    'news_paragraph': True,
+    'featured_image': True,
+    'featured_image_variants': True,
+    'facts': True,
+    'hemisphere_image_urls': True,
+    'last_modified': True,
+    'source_updated': True,
+    'version': True,
+}
+
+
+class DocumentCache:
+
+    # Keeps the single mars document in memory. A background thread clears it when
+    # a change stream reports a write, or when the `version` field moves if change
+    # streams are unavailable (standalone mongod, in-memory stand-ins)
+
+    def __init__(self, collection, projection=INDEX_PROJECTION, poll_interval=5):
+        self.collection = collection
+        self.projection = projection
+        self.poll_interval = poll_interval
+        self.lock = threading.Lock()
+        self.loaded = False
+        self.document = None
+        self.generation = 0
+        self.watcher = None
+
+    def get(self):
+        self.start()
+        hit, document, generation = self._lookup()
+        if hit:
+            return document
+        with metrics.span('find_one', metrics.MONGO_SECONDS, operation='find_one'):
+            document = self.collection.find_one({}, projection=self.projection)
+        return self._store(generation, document)
+
+    def _lookup(self):
+        with self.lock:
+            metrics.cache_result('document', self.loaded)
+            return self.loaded, self.document, self.generation
+
+    def _store(self, generation, document):
+
+        # Don't keep a read that raced with an invalidation
+        with self.lock:
+            if generation == self.generation:
+                self.document = document
+                self.loaded = True
+        return document
+
+    def invalidate(self):
+        with self.lock:
+            self.generation += 1
+            self.loaded = False
+            self.document = None
+
+    def start(self):
+
+        # Start watching on first use, so forked workers each get their own thread
+        with self.lock:
+            if self.watcher is not None and self.watcher.is_alive():
+                return
+            self.watcher = threading.Thread(target=self._watch, daemon=True)
+            self.watcher.start()
+
+    def _watch(self):
+
+        # A read cached before the stream opened (or before the first version sample)
+        # could miss a write made in between, so drop it once watching has started
+        try:
+            with self.collection.watch() as stream:
+                self.invalidate()
+                for _ in stream:
+                    self.invalidate()
+        except (PyMongoError, NotImplementedError):
+            self._poll()
+
+    def _poll(self):
+        while True:
+            try:
+                version = self._version()
+                break
+            except PyMongoError:
+                time.sleep(self.poll_interval)
+        self.invalidate()
+        while True:
+            time.sleep(self.poll_interval)
+            try:
+                current = self._version()
+            except PyMongoError:
+                continue
+            if current != version:
+                version = current
+                self.invalidate()
+
+    def _version(self):
+        document = self.collection.find_one({}, projection={'version': True, 'last_modified': True})
+        if document is None:
+            return None
+        return document.get('version', document.get('last_modified'))
+
+
+class AsyncDocumentCache(DocumentCache):
+
+    # The same cache on a Motor collection, for asgi.py. Reads await the driver and
+    # the watcher is a task on the worker's event loop instead of a thread
+
+    async def get(self):
+        self.start()
+        hit, document, generation = self._lookup()
+        if hit:
+            return document
+        with metrics.span('find_one', metrics.MONGO_SECONDS, operation='find_one'):
+            document = await self.collection.find_one({}, projection=self.projection)
+        return self._store(generation, document)
+
+    def start(self):
+        if self.watcher is None or self.watcher.done():
+            self.watcher = asyncio.get_running_loop().create_task(self._watch())
+
+    def stop(self):
+        if self.watcher is not None:
+            self.watcher.cancel()
+
+    async def _watch(self):
+        try:
+            async with self.collection.watch() as stream:
+
+                # Motor opens the stream lazily, on the first fetch
+                await stream.try_next()
+                self.invalidate()
+                async for _ in stream:
+                    self.invalidate()
+        except (PyMongoError, NotImplementedError):
+            await self._poll()
+
+    async def _poll(self):
+        while True:
+            try:
+                version = await self._version()
+                break
+            except PyMongoError:
+                await asyncio.sleep(self.poll_interval)
+        self.invalidate()
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            try:
+                current = await self._version()
+            except PyMongoError:
+                continue
+            if current != version:
+                version = current
+                self.invalidate()
+
+    async def _version(self):
+        document = await self.collection.find_one({}, projection={'version': True, 'last_modified': True})
+        if document is None:
+            return None
+        return document.get('version', document.get('last_modified'))
@@ -0,0 +1,165 @@
+# Write scrapes to Mongo as field level diffs and keep a compact change history
+import base64
+import datetime as dt
+import json
+import os
+from pymongo import ASCENDING, DESCENDING
+import metrics
+
+
+# Names of the scraped sources
+SOURCES = ('news', 'featured_image', 'facts', 'hemispheres')
+
+# Which source each scraped field comes from
+FIELD_SOURCES = {
+    'news_title': 'news',
+    'news_paragraph': 'news',
+    'featured_image': 'featured_image',
+    'featured_image_variants': 'featured_image',
+    'facts': 'facts',
+    'hemisphere_image_urls': 'hemispheres',
+}
+
+# Seconds before a source's data is stale and `/` refreshes it in the background,
+# e.g. MARS_TTL_FACTS=86400
+SOURCE_TTLS = {
+    source: int(os.environ.get(f'MARS_TTL_{source.upper()}', default))
+    for source, default in (
+        ('news', 15 * 60),
+        ('featured_image', 30 * 60),
+        ('facts', 7 * 24 * 3600),
+        ('hemispheres', 24 * 3600),
+    )
+}
+
+
+# Largest page the news API returns
+NEWS_PAGE_LIMIT = 100
+
+
+def ensure_indexes(db):
+    db.mars_history.create_index([('source', ASCENDING), ('timestamp', DESCENDING)])
+    db.mars_history.create_index([('timestamp', DESCENDING)])
+    ensure_news_indexes(db)
+
+
+def ensure_news_indexes(db):
+    db.news.create_index([('published', DESCENDING), ('_id', DESCENDING)])
+
+
+def returned(data):
+
+    # Sources that came back with data, failed ones only carry their empty values
+    return {
+        source for source in SOURCES
+        if any(data.get(f) for f, s in FIELD_SOURCES.items() if s == source)
+    }
+
+
+def diff(current, data, sources=None):
+
+    # Fields of the new scrape that differ from the stored document, limited to
+    # `sources` so a failed source never blanks the values it scraped before
+    return {
+        field: value for field, value in data.items()
+        if field in FIELD_SOURCES
+        and (sources is None or FIELD_SOURCES[field] in sources)
+        and (current or {}).get(field) != value
+    }
+
+
+def save_scrape(db, data):
+    with metrics.span('save_scrape', metrics.MONGO_SECONDS, operation='save_scrape'):
+        return _save_scrape(db, data)
+
+
+def _save_scrape(db, data):
+
+    # `$set` only the fields that changed and append one history delta per source
+    current = db.mars.find_one({}, projection=list(FIELD_SOURCES))
+    timestamp = data.get('last_modified') or dt.datetime.now()
+
+    # Sources that came back with data count as refreshed, failed ones stay stale
+    # and keep their stored values
+    sources = returned(data)
+    changes = diff(current, data, sources)
+    refreshed = {f'source_updated.{source}': timestamp for source in sources}
+
+    # `version` lets readers without change streams notice the write
+    update = {'$set': dict(changes, last_modified=timestamp, **refreshed), '$inc': {'version': 1}}
+    db.mars.update_one({}, update, upsert=True)
+
+    deltas = {}
+    for field, value in changes.items():
+        deltas.setdefault(FIELD_SOURCES[field], {})[field] = value
+    if deltas:
+        db.mars_history.insert_many([
+            {'source': source, 'timestamp': timestamp, 'changes': fields}
+            for source, fields in deltas.items()
+        ])
+
+    return changes
+
+
+def stale_sources(document, now=None):
+
+    # Sources never scraped or older than their TTL
+    now = now or dt.datetime.now()
+    updated = (document or {}).get('source_updated') or {}
+    return [
+        source for source in SOURCES
+        if updated.get(source) is None
+        or (now - updated[source]).total_seconds() > SOURCE_TTLS[source]
+    ]
+
+
+def history(db, start=None, end=None, source=None):
+
+    # Change history between `start` and `end`, oldest first
+    query = {}
+    if source is not None:
+        query['source'] = source
+    if start is not None or end is not None:
+        query['timestamp'] = {}
+        if start is not None:
+            query['timestamp']['$gte'] = start
+        if end is not None:
+            query['timestamp']['$lt'] = end
+    return db.mars_history.find(query, projection={'_id': False}).sort('timestamp', ASCENDING)
+
+
+def _encode_cursor(article):
+    value = json.dumps([article['published'].isoformat(), article['_id']])
+    return base64.urlsafe_b64encode(value.encode('utf-8')).decode('ascii')
+
+
+def _decode_cursor(cursor):
+
+    # Bad base64 and JSON already raise ValueError, anything but a
+    # [published, _id] pair of strings is rejected the same way
+    value = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    if not (isinstance(value, list) and len(value) == 2 and all(isinstance(v, str) for v in value)):
+        raise ValueError(f'malformed cursor: {cursor!r}')
+    published, article_id = value
+    return dt.datetime.fromisoformat(published), article_id
+
+
+def news_query(cursor=None, limit=20):
+
+    # Query, sort and limit of a page of news, newest first. `cursor` is the `next`
+    # value of the previous page, it resumes after the last (published, _id) pair so
+    # pages never shift or repeat
+    limit = max(1, min(limit, NEWS_PAGE_LIMIT))
+    query = {}
+    if cursor:
+        published, article_id = _decode_cursor(cursor)
+        query = {'$or': [
+            {'published': {'$lt': published}},
+            {'published': published, '_id': {'$lt': article_id}},
+        ]}
+    return query, [('published', DESCENDING), ('_id', DESCENDING)], limit
+
+
+def next_cursor(articles, limit):
+    return _encode_cursor(articles[-1]) if len(articles) == limit else None
+
@@ -0,0 +1,169 @@
+# Minimal in-process metrics, exported in the Prometheus text format
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# OpenTelemetry is optional, without it `span` only records the duration
+try:
+    from opentelemetry import trace
+    tracer = trace.get_tracer('mission_to_mars')
+except ImportError:
+    tracer = None
+
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Histogram buckets in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def _labels(names, values):
+    return ','.join(f'{name}="{value}"' for name, value in zip(names, values))
+
+
+def _series(name, labels):
+    return f'{name}{{{labels}}}' if labels else name
+
+
+class Counter:
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels[name]) for name in self.label_names)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                lines.append(f'{_series(self.name, _labels(self.label_names, key))} {value}')
+        return lines
+
+
+class Histogram:
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self.buckets = tuple(buckets)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels[name]) for name in self.label_names)
+        with self.lock:
+            series = self.values.setdefault(key, {'buckets': [0] * len(self.buckets), 'sum': 0.0, 'count': 0})
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series['buckets'][i] += 1
+            series['sum'] += value
+            series['count'] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        with self.lock:
+            for key, series in sorted(self.values.items()):
+                base = _labels(self.label_names, key)
+                sep = ',' if base else ''
+                for bound, bucket_count in zip(self.buckets, series['buckets']):
+                    lines.append(f'{self.name}_bucket{{{base}{sep}le="{bound}"}} {bucket_count}')
+                lines.append(f'{self.name}_bucket{{{base}{sep}le="+Inf"}} {series["count"]}')
+                lines.append(f'{_series(self.name + "_sum", base)} {series["sum"]}')
+                lines.append(f'{_series(self.name + "_count", base)} {series["count"]}')
+        return lines
+
+
+# Every metric of the app and the worker
+SCRAPE_STAGE_SECONDS = Histogram(
+    'mars_scrape_stage_seconds', 'Time spent per source and stage (fetch, parse, extract)',
+    labels=('source', 'stage'))
+SCRAPE_FAILURES = Counter(
+    'mars_scrape_failures_total', 'Scrape failures per source and the except branch that fired',
+    labels=('source', 'branch'))
+BROWSER_LAUNCH_SECONDS = Histogram(
+    'mars_browser_launch_seconds', 'Time to start a headless Chrome browser')
+MONGO_SECONDS = Histogram(
+    'mars_mongo_seconds', 'Mongo read and write latency', labels=('operation',))
+TEMPLATE_RENDER_SECONDS = Histogram(
+    'mars_template_render_seconds', 'Time to render a template', labels=('template',))
+CACHE_REQUESTS = Counter(
+    'mars_cache_requests_total', 'Cache lookups per cache and result (hit or miss)',
+    labels=('cache', 'result'))
+
+REGISTRY = [
+    SCRAPE_STAGE_SECONDS, SCRAPE_FAILURES, BROWSER_LAUNCH_SECONDS,
+    MONGO_SECONDS, TEMPLATE_RENDER_SECONDS, CACHE_REQUESTS,
+]
+
+
+def cache_result(cache, hit):
+    CACHE_REQUESTS.inc(cache=cache, result='hit' if hit else 'miss')
+
+
+@contextmanager
+def span(name, histogram=None, **labels):
+
+    # Time a block into `histogram` and, if OpenTelemetry is installed, trace it
+    if tracer is None:
+        if histogram is None:
+            yield
+        else:
+            with histogram.time(**labels):
+                yield
+        return
+    with tracer.start_as_current_span(name, attributes=labels):
+        if histogram is None:
+            yield
+        else:
+            with histogram.time(**labels):
+                yield
+
+
+def render():
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        body = render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port):
+
+    # Expose /metrics from processes without a web app, like the worker
+    server = ThreadingHTTPServer(('', port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
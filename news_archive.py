@@ -0,0 +1,108 @@
+# Ingest every article of the news site into the `news` collection
+import datetime as dt
+import hashlib
+import os
+from urllib.parse import urljoin
+from pymongo import MongoClient, UpdateOne
+import html_parser
+import mars_store
+import scraping
+
+
+# Articles written per bulk_write call
+BATCH_SIZE = 500
+
+# Stop following pagination after this many pages
+MAX_PAGES = 100
+
+# Date format of `div.list_date`, e.g. "November 1, 2020"
+DATE_FORMAT = '%B %d, %Y'
+
+
+def article_id(title, url):
+
+    # Articles are keyed by a hash of their title and link
+    return hashlib.sha1(f'{title}\n{url or ""}'.encode('utf-8')).hexdigest()
+
+
+def parse_date(text):
+    try:
+        return dt.datetime.strptime(text.strip(), DATE_FORMAT)
+    except (AttributeError, ValueError):
+        return None
+
+
+def parse_articles(html, base_url):
+
+    # Every article of a page plus the link to the next page, if there is one
+    doc = html_parser.parse(html)
+    articles = []
+    for item in doc.select('div.list_text'):
+        title_elem = item.select_one('div.content_title')
+        if title_elem is None:
+            continue
+        link = title_elem.select_one('a') or item.select_one('a')
+        href = link.attr('href') if link is not None else None
+        teaser = item.select_one('div.article_teaser_body')
+        date_elem = item.select_one('div.list_date')
+        articles.append({
+            'title': title_elem.text().strip(),
+            'paragraph': teaser.text().strip() if teaser is not None else None,
+            'url': urljoin(base_url, href) if href else None,
+            'published': parse_date(date_elem.text()) if date_elem is not None else None,
+        })
+
+    next_link = doc.select_one('a[rel="next"]') or doc.find_text('a', 'Next') or doc.find_text('a', 'More')
+    next_url = urljoin(base_url, next_link.attr('href')) if next_link is not None and next_link.attr('href') else None
+    return articles, next_url
+
+
+def iter_articles(url=None, max_pages=MAX_PAGES):
+
+    # Yield articles page by page, following pagination until it runs out
+    url = url or scraping.NEWS_URL
+    seen = set()
+    for _ in range(max_pages):
+        if url is None or url in seen:
+            return
+        seen.add(url)
+        articles, url = parse_articles(scraping.fetch_html(url), url)
+        yield from articles
+
+
+def ingest(db, url=None, batch_size=BATCH_SIZE):
+
+    # Upsert the articles in unordered bulk writes of `batch_size`, never holding
+    # more than one batch in memory
+    mars_store.ensure_news_indexes(db)
+    now = dt.datetime.now()
+    written = 0
+    batch = []
+    for article in iter_articles(url):
+        article['_id'] = article_id(article['title'], article['url'])
+
+        # Undated articles are placed at the time they were first seen, later
+        # ingests must not move them
+        on_insert = {'first_seen': now}
+        if article['published'] is None:
+            del article['published']
+            on_insert['published'] = now
+        batch.append(UpdateOne(
+            {'_id': article['_id']},
+            {'$set': article, '$setOnInsert': on_insert},
+            upsert=True))
+        if len(batch) >= batch_size:
+            db.news.bulk_write(batch, ordered=False)
+            written += len(batch)
+            batch = []
+    if batch:
+        db.news.bulk_write(batch, ordered=False)
+        written += len(batch)
+    return written
+
+
+if __name__ == "__main__":
+
+    # If running as script, ingest the whole feed once
+    db = MongoClient(os.environ.get('MONGO_URI', 'mongodb://localhost:27017/mars_app')).get_default_database()
+    print(f'{ingest(db)} articles written')
@@ -0,0 +1,131 @@
+# Record the source sites to fixtures and replay them from a local HTTP server
+import argparse
+import hashlib
+import os
+import threading
+import time
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+import scraping
+
+
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+# Module level URLs of the scrapers that replay rewrites
+SOURCE_URL_NAMES = ('NEWS_URL', 'FEATURED_IMAGE_URL', 'FACTS_URL', 'HEMISPHERES_URL')
+
+
+def fixture_path(directory, url):
+
+    # Fixtures are stored as <directory>/<host>/<path>, directory URLs as index.html
+    parsed = urlparse(url)
+    path = parsed.path.lstrip('/')
+    if not path or path.endswith('/'):
+        path += 'index.html'
+    return os.path.join(directory, parsed.netloc, *path.split('/'))
+
+
+def record(directory=FIXTURE_DIR):
+
+    # Save the four source pages plus every hemisphere detail page
+    urls = [getattr(scraping, name) for name in SOURCE_URL_NAMES]
+    index_html = scraping.fetch_html(scraping.HEMISPHERES_URL)
+    urls += scraping.parse_hemisphere_links(index_html, scraping.HEMISPHERES_URL) or []
+
+    for url in urls:
+        path = fixture_path(directory, url)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        response = scraping.http.get(url, timeout=scraping.HTTP_TIMEOUT)
+        response.raise_for_status()
+        with open(path, 'wb') as f:
+            f.write(response.content)
+        print(f'recorded {url} -> {path}')
+
+
+class ReplayHandler(SimpleHTTPRequestHandler):
+
+    # Serves fixtures with an ETag, and with injected latency and bandwidth limits
+
+    latency = 0
+    bandwidth = None
+
+    def do_GET(self):
+        time.sleep(self.latency)
+        path = self.translate_path(self.path)
+        if os.path.isdir(path):
+            path = os.path.join(path, 'index.html')
+        try:
+            with open(path, 'rb') as f:
+                body = f.read()
+        except OSError:
+            self.send_error(404)
+            return
+
+        etag = '"%s"' % hashlib.sha256(body).hexdigest()[:32]
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', self.guess_type(path))
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        self.end_headers()
+        self._write(body)
+
+    def _write(self, body):
+        if not self.bandwidth:
+            self.wfile.write(body)
+            return
+
+        # Trickle the body out in 10 ms slices to hold the byte rate
+        chunk = max(1, int(self.bandwidth / 100))
+        for start in range(0, len(body), chunk):
+            self.wfile.write(body[start:start + chunk])
+            time.sleep(0.01)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(directory=FIXTURE_DIR, port=0, latency=0, bandwidth=None):
+
+    # Start a replay server in a background thread, returns the server (server.base_url)
+    handler = type('Handler', (ReplayHandler,), {'latency': latency, 'bandwidth': bandwidth})
+    server = ThreadingHTTPServer(
+        ('127.0.0.1', port), lambda *args: handler(*args, directory=directory))
+    server.daemon_threads = True
+    server.base_url = f'http://127.0.0.1:{server.server_address[1]}'
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def use_replay(base_url):
+
+    # Point the scrapers at the replay server, relative links stay on it too
+    for name in SOURCE_URL_NAMES:
+        parsed = urlparse(getattr(scraping, name))
+        setattr(scraping, name, f'{base_url}/{parsed.netloc}{parsed.path or "/"}')
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Record or replay the Mars source sites')
+    parser.add_argument('command', choices=['record', 'serve'])
+    parser.add_argument('--dir', default=FIXTURE_DIR)
+    parser.add_argument('--port', type=int, default=8800)
+    parser.add_argument('--latency', type=float, default=0, help='seconds added to every response')
+    parser.add_argument('--bandwidth', type=int, default=None, help='bytes per second per response')
+    args = parser.parse_args()
+
+    if args.command == 'record':
+        record(args.dir)
+    else:
+        server = serve(args.dir, args.port, args.latency, args.bandwidth)
+        print(f'replaying {args.dir} on {server.base_url}')
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            server.shutdown()
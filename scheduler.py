@@ -0,0 +1,105 @@
+# Refresh each source on its own interval, with jitter and without overlapping runs
+import heapq
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import mars_store
+import metrics
+
+
+# Seconds between scheduled refreshes of each source, by default a bit under its
+# TTL so pages find fresh data, e.g. MARS_INTERVAL_NEWS=600
+SOURCE_INTERVALS = {
+    source: int(os.environ.get(f'MARS_INTERVAL_{source.upper()}', ttl * 0.8))
+    for source, ttl in mars_store.SOURCE_TTLS.items()
+}
+
+# Each run is moved by up to this fraction of its interval, so sources drift apart
+JITTER = float(os.environ.get('MARS_SCHEDULE_JITTER', 0.1))
+
+# Most scheduled runs at the same time, across all sources
+MAX_CONCURRENT = int(os.environ.get('MARS_SCHEDULE_MAX_CONCURRENT', 2))
+
+# Seconds to wait before retrying a run that was held back
+RETRY_DELAY = 5
+
+
+# One lock per source, held by whoever is scraping it (scheduled runs and queued jobs)
+source_locks = {source: threading.Lock() for source in mars_store.SOURCES}
+
+
+class Scheduler:
+
+    # Each source has a single heap entry, so runs of it never stack up. A due run
+    # that finds its source busy (a queued job holds the lock) is coalesced into one
+    # retry after RETRY_DELAY, and so is one that finds MAX_CONCURRENT runs going
+
+    def __init__(self, run, intervals=SOURCE_INTERVALS, jitter=JITTER, max_concurrent=MAX_CONCURRENT):
+        self.run = run
+        self.intervals = intervals
+        self.jitter = jitter
+        self.slots = threading.BoundedSemaphore(max_concurrent)
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrent)
+        self.queue = []
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.stopped = threading.Event()
+
+    def _delay(self, source):
+        interval = self.intervals[source]
+        return interval + random.uniform(-self.jitter, self.jitter) * interval
+
+    def _schedule(self, source, delay):
+        with self.lock:
+            heapq.heappush(self.queue, (time.monotonic() + delay, source))
+        self.wakeup.set()
+
+    def start(self):
+
+        # First runs are spread over the jitter window instead of all firing at once
+        for source, interval in self.intervals.items():
+            self._schedule(source, random.uniform(0, self.jitter * interval))
+        thread = threading.Thread(target=self._loop, daemon=True)
+        thread.start()
+        return thread
+
+    def stop(self):
+        self.stopped.set()
+        self.wakeup.set()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def _loop(self):
+        while not self.stopped.is_set():
+            with self.lock:
+                due = self.queue[0][0] - time.monotonic() if self.queue else None
+                if due is not None and due <= 0:
+                    _, source = heapq.heappop(self.queue)
+                else:
+                    source = None
+            if source is None:
+                self.wakeup.wait(timeout=due)
+                self.wakeup.clear()
+                continue
+            self._dispatch(source)
+
+    def _dispatch(self, source):
+        if not source_locks[source].acquire(blocking=False):
+            self._schedule(source, RETRY_DELAY)
+            return
+        if not self.slots.acquire(blocking=False):
+            source_locks[source].release()
+            self._schedule(source, RETRY_DELAY)
+            return
+        self.executor.submit(self._run, source)
+
+    def _run(self, source):
+        try:
+            self.run(source)
+        except Exception as e:
+            metrics.SCRAPE_FAILURES.inc(source=source, branch=f'scheduled:{type(e).__name__}')
+        finally:
+            self.slots.release()
+            source_locks[source].release()
+            self._schedule(source, self._delay(source))
@@ -1,168 +1,487 @@
-# Import Splinter and BeautifulSoup
-from types import new_class
-from splinter import Browser
-from bs4 import BeautifulSoup as soup
-import pandas as pd
+# Import the HTML parser and HTTP client
+from extraction import EXTRACTORS
 import datetime as dt
-from webdriver_manager.chrome import ChromeDriverManager
+import requests
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from contextlib import ExitStack, contextmanager
+from functools import partial
+from urllib.parse import urljoin, urlparse
+from browser_pool import pool
+from http_cache import HTTPCache
+from table_parser import parse_table
+import metrics
 
 
-def scrape_all():
-
-    # Initiate headless driver for deployment / Set up Splinter
-    executable_path = {'executable_path': ChromeDriverManager().install()}
-    browser = Browser('chrome', **executable_path, headless=True)
+# Source pages for each scraper
+NEWS_URL = 'https://data-class-mars.s3.amazonaws.com/Mars/index.html'
+FEATURED_IMAGE_URL = 'https://data-class-jpl-space.s3.amazonaws.com/JPL_Space/index.html'
+FACTS_URL = 'https://data-class-mars-facts.s3.amazonaws.com/Mars_Facts/index.html'
+HEMISPHERES_URL = 'https://marshemispheres.com/'
 
+# Seconds to wait on a plain HTTP fetch before giving up on it
+HTTP_TIMEOUT = 10
+
+# Seconds each source may take in a concurrent scrape before its key is left empty
+SOURCE_DEADLINES = {
+    'news': 10,
+    'featured_image': 10,
+    'facts': 10,
+    'hemispheres': 20,
+}
+
+# Most hemisphere detail pages fetched at the same time
+HEMISPHERE_CONCURRENCY = 4
+
+# Most requests to the same host at the same time, across all scrapes of the process
+HOST_CONCURRENCY = 4
+host_slots = {}
+host_slots_lock = threading.Lock()
+
+# Reuse one HTTP session so connections to the source hosts are kept alive
+http = requests.Session()
+http.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize=32))
+http.mount('http://', requests.adapters.HTTPAdapter(pool_maxsize=32))
+
+# Unchanged pages are answered from the cache without being parsed again
+cache = HTTPCache(http)
+
+
+@contextmanager
+def host_slot(url):
+
+    # Hold one of HOST_CONCURRENCY slots for the url's host
+    host = urlparse(url).netloc
+    with host_slots_lock:
+        slot = host_slots.setdefault(host, threading.BoundedSemaphore(HOST_CONCURRENCY))
+    with slot:
+        yield
+
+
+def fetch_html(url):
+
+    # Download the static HTML of a page without starting a browser
+    with host_slot(url):
+        response = http.get(url, timeout=HTTP_TIMEOUT)
+    response.raise_for_status()
+    return response.text
+
+
+def failed(source, branch):
+
+    # Count which except branch of a scraper fired
+    metrics.SCRAPE_FAILURES.inc(source=source, branch=branch)
+
+
+def cached_parse(url, name, parse, version=None):
+
+    # Fetch a page with a conditional request and only parse it when it changed.
+    # Results of an extraction spec are stored under its version, so editing
+    # extraction.json takes effect on unchanged pages too
+    if version is None and name in EXTRACTORS:
+        version = EXTRACTORS[name].version
+    with host_slot(url):
+        return cache.extract(url, name, parse, timeout=HTTP_TIMEOUT, version=version)
+
+
+class SessionClosed(RuntimeError):
+    pass
+
+
+class BrowserSession:
+
+    # Holds a Splinter browser that is only leased from the warm pool the first
+    # time a scraper has to fall back to it, so scrapes served over plain HTTP
+    # never touch Chrome
+
+    # Concurrent scrapers share the session, `drive_lock` keeps them from driving
+    # the same Chrome window at once. `lock` only guards the session's state and is
+    # never held across a lease or a release, so `quit()` just marks the session
+    # closed: a scraper still running past its deadline keeps the browser, and the
+    # last user out hands the lease back to the pool
+
+    def __init__(self, pool=pool):
+        self.pool = pool
+        self.browser = None
+        self.failed = None
+        self.closed = False
+        self.leasing = False
+        self.released = False
+        self.users = 0
+        self.lease = ExitStack()
+        self.lock = threading.Lock()
+        self.drive_lock = threading.RLock()
+
+    def get(self):
+
+        # Callers hold `drive_lock`, so only one of them leases at a time
+        with self.lock:
+            if self.closed:
+                raise SessionClosed('browser session already closed')
+            if self.browser is not None:
+                return self.browser
+            self.leasing = True
+        lease = ExitStack()
+        try:
+            browser = lease.enter_context(self.pool.lease())
+        finally:
+            with self.lock:
+                self.leasing = False
+
+        # The session may have closed while the pool launched or freed a browser
+        with self.lock:
+            if not self.closed:
+                self.lease = lease
+                self.browser = browser
+                return browser
+        lease.close()
+        raise SessionClosed('browser session closed while leasing')
+
+    def enter(self):
+        with self.lock:
+            if self.closed:
+                raise SessionClosed('browser session already closed')
+            self.users += 1
+
+    def leave(self):
+        with self.lock:
+            self.users -= 1
+            release = self._should_release()
+        if release:
+            self._release()
+
+    def quit(self):
+
+        # Close the session; the browser goes back now if nobody is using it,
+        # otherwise when the last scraper using it leaves
+        with self.lock:
+            self.closed = True
+            release = self._should_release()
+        if release:
+            self._release()
+
+    def _should_release(self):
+        if self.closed and self.users == 0 and not self.leasing and not self.released:
+            self.released = True
+            return True
+        return False
+
+    def _release(self):
+
+        # Hand the browser back to the pool, which resets or recycles it. After a
+        # failed scrape the pool tears the browser down instead
+        self.browser = None
+        failed, self.failed = self.failed, None
+        if failed is None:
+            self.lease.close()
+        else:
+            self.lease.__exit__(type(failed), failed, failed.__traceback__)
+
+
+@contextmanager
+def _using(browser):
+
+    # Scrapers accept either a Splinter browser or a lazy BrowserSession
+    if isinstance(browser, BrowserSession):
+        browser.enter()
+        try:
+            with browser.drive_lock:
+                try:
+                    yield browser.get()
+                except SessionClosed:
+                    raise
+                except BaseException as e:
+                    browser.failed = e
+                    raise
+        finally:
+            browser.leave()
+    else:
+        yield browser
+
+
+# Each source fills its own keys of the scrape result
+def _scrape_news(browser):
     news_title, news_paragraph = mars_news(browser)
+    return {"news_title": news_title, "news_paragraph": news_paragraph}
 
-    # Run all scraping functions and store results in dictionary
-    data = {
-        "news_title": news_title,
-        "news_paragraph": news_paragraph,
-        "featured_image": featured_image(browser),
-        "facts": mars_facts(),
-        "last_modified": dt.datetime.now(),
-        "hemisphere_image_urls": hemispheres_images(browser)
-        }
-
-    # Stop webdriver and return data
-    browser.quit()
-    return data
+def _scrape_featured_image(browser):
+    return {"featured_image": featured_image(browser)}
 
-def mars_news(browser):
+def _scrape_facts(browser):
+    return {"facts": mars_facts()}
 
-    # Scrape Mars News
-    # Visit the Mars NASA news site
-    url = 'https://data-class-mars.s3.amazonaws.com/Mars/index.html'
-    browser.visit(url)
+def _scrape_hemispheres(browser):
+    return {"hemisphere_image_urls": hemispheres_images(browser)}
 
-    # Optional delay for loading the page
-    browser.is_element_present_by_css('div.list_text', wait_time=3)
+SOURCES = {
+    'news': _scrape_news,
+    'featured_image': _scrape_featured_image,
+    'facts': _scrape_facts,
+    'hemispheres': _scrape_hemispheres,
+}
 
+# Sources that fail or miss their deadline keep these empty values
+EMPTY_RESULTS = {
+    'news': {"news_title": None, "news_paragraph": None},
+    'featured_image': {"featured_image": None},
+    'facts': {"facts": None},
+    'hemispheres': {"hemisphere_image_urls": []},
+}
 
-    # Set up the HTML parser: Convert the browser html to a soup object and then quit the browser
-    html = browser.html
-    news_soup = soup(html, 'html.parser')
 
-    # Add try/except for error handling
+def scrape_all(concurrent=True, deadlines=None, progress=None, sources=None,
+               on_result=None, use_browser=True):
+
+    # Set up a lazy browser, Chrome only starts if a selector is missing from the static HTML.
+    # Without `use_browser` there is no fallback at all
+    browser = BrowserSession() if use_browser else None
+
+    # Only the selected sources are scraped, the result only has their keys
+    selected = {name: SOURCES[name] for name in (sources or SOURCES)}
+    data = {}
+    for name in selected:
+        data.update(EMPTY_RESULTS[name])
+
     try:
+        if concurrent:
+            _scrape_concurrent(browser, data, selected, dict(SOURCE_DEADLINES, **(deadlines or {})),
+                               progress, on_result)
+        else:
+            # Run all scraping functions one after another
+            for name, scraper in selected.items():
+                result = _run_source(name, scraper, browser)
+                data.update(result)
+                if on_result is not None:
+                    on_result(name, result)
+                if progress is not None:
+                    progress(name)
+
+    finally:
+        # Return the browser to the pool (if one was leased) and return data
+        if browser is not None:
+            browser.quit()
+
+    data["last_modified"] = dt.datetime.now()
+    return data
 
-        slide_elem = news_soup.select_one('div.list_text')
 
+def _run_source(name, scraper, browser):
 
-        # Begin scraping: trying to get the title for the most recent article published on the website.
-        # slide_elem.find('div', class_='content_title')
+    # Time a whole source and count the exceptions its scraper doesn't handle
+    try:
+        with metrics.span(name, metrics.SCRAPE_STAGE_SECONDS, source=name, stage='extract'):
+            return scraper(browser)
+    except BaseException as e:
+        failed(name, type(e).__name__)
+        raise
+
+
+def _scrape_concurrent(browser, data, sources, deadlines, progress=None, on_result=None):
+
+    # Run every source at once so the scrape takes as long as the slowest one
+    executor = ThreadPoolExecutor(max_workers=len(sources))
+    lock = threading.Lock()
+    collecting = [True]
+
+    def fill(name, future):
+        # Store a source's keys as soon as it finishes, unless the scrape already returned
+        if future.cancelled() or future.exception() is not None:
+            return
+        with lock:
+            if collecting[0]:
+                data.update(future.result())
+                if on_result is not None:
+                    on_result(name, future.result())
+                if progress is not None:
+                    progress(name)
+
+    started = time.monotonic()
+    futures = {}
+    for name, scraper in sources.items():
+        futures[name] = executor.submit(_run_source, name, scraper, browser)
+        futures[name].add_done_callback(partial(fill, name))
+
+    # Wait for each source up to its own deadline, a late or failed source leaves its keys empty
+    for name, future in futures.items():
+        remaining = started + deadlines[name] - time.monotonic()
+        try:
+            future.result(timeout=max(remaining, 0))
+        except TimeoutError:
+            failed(name, 'deadline')
+        except Exception:
+            continue
+
+    with lock:
+        collecting[0] = False
+    executor.shutdown(wait=False, cancel_futures=True)
+
+def mars_news(browser=None, url=None):
 
+    # Scrape Mars News
+    # Fetch the Mars NASA news site over plain HTTP first
+    url = url or NEWS_URL
+    try:
+        news_title, news_p = cached_parse(url, 'news', parse_news) or (None, None)
+    except requests.RequestException:
+        failed('news', 'RequestException')
+        news_title, news_p = None, None
 
-        # Use the parent element to find the first `a` tag and save it as `news_title`
-        news_title = slide_elem.find('div', class_='content_title').get_text()
+    if news_title is not None or browser is None:
+        return news_title, news_p
 
+    # Fall back to the browser when the articles are missing from the static HTML
+    with _using(browser) as browser:
+        browser.visit(url)
 
-        # Use the parent element to find the paragraph text (article summary)
-        news_p = slide_elem.find('div', class_='article_teaser_body').get_text()
-    
-    except AttributeError:
-        return None, None
-    
-    
-    return news_title, news_p
+        # Optional delay for loading the page
+        browser.is_element_present_by_css('div.list_text', wait_time=3)
 
+        return parse_news(browser.html) or (None, None)
 
-# ## JPL Space Images Featured Image
 
-def featured_image(browser):
+def parse_news(html):
 
-    # Visit URL
-    url = 'https://data-class-jpl-space.s3.amazonaws.com/JPL_Space/index.html'
-    browser.visit(url)
+    # Title and teaser of the first `div.list_text`, see the `news` spec in extraction.json
+    fields = EXTRACTORS['news'].extract(html)
+    if fields['news_title'] is None or fields['news_paragraph'] is None:
+        failed('news', 'missing_selector')
+        return None
 
-    # Find and click the full image button
-    full_image_elem = browser.find_by_tag('button')[1]
-    full_image_elem.click()
+    return fields['news_title'], fields['news_paragraph']
 
-    # Parse the resulting html with soup
-    html = browser.html
-    img_soup = soup(html, 'html.parser')
 
-    # Add try/except for error handling
-    try: 
+# ## JPL Space Images Featured Image
+
+def featured_image(browser=None, url=None):
+
+    # The full size image is already linked from the header of the static page
+    url = url or FEATURED_IMAGE_URL
+    try:
+        img_url_rel = cached_parse(url, 'featured_image', parse_featured_image)
+    except requests.RequestException:
+        failed('featured_image', 'RequestException')
+        img_url_rel = None
+
+    if img_url_rel is None and browser is not None:
 
-        # Find the relative image URL
-        img_url_rel = img_soup.find('img', class_='fancybox-image').get('src')
-    
-    except AttributeError:
+        # Fall back to the browser: visit URL and click the full image button
+        with _using(browser) as browser:
+            browser.visit(url)
+            full_image_elem = browser.find_by_tag('button')[1]
+            full_image_elem.click()
+            img_url_rel = parse_featured_image(browser.html)
+
+    if img_url_rel is None:
         return None
 
 
-    # Use the bsae URL to create an absolute URL
-    img_url = f'https://data-class-jpl-space.s3.amazonaws.com/JPL_Space/{img_url_rel}'
+    # Use the base URL to create an absolute URL
+    img_url = urljoin(url, img_url_rel)
 
-    
-    
     return img_url
 
 
+def parse_featured_image(html):
+
+    # Find the image URL, the fancybox image only exists after the button click
+    fields = EXTRACTORS['featured_image'].extract(html)
+    img_url_rel = fields['full_image'] or fields['header_image']
+    if img_url_rel is None:
+        failed('featured_image', 'missing_selector')
+
+    return img_url_rel
+
+
 # ## Mars Facts
 
-def mars_facts():
+def mars_facts(url=None):
 
     # Add try/except for error handling
     try:
+        return cached_parse(url or FACTS_URL, 'facts_rows', parse_facts)
 
-        # use `read_html` to scrape the facts table into a dataframe
-        df = pd.read_html('https://data-class-mars-facts.s3.amazonaws.com/Mars_Facts/index.html')[0]
-    
-    except BaseException:
+    except BaseException as e:
+        failed('facts', f'BaseException:{type(e).__name__}')
         return None
-    
-    # Assign columns and set index of dataframe
-    df.columns=['description', 'Mars', 'Earth']
-    df.set_index('description', inplace=True)
-    
 
-    # Convert DataFrame back into HTML format using the `.to_html()` function, add bootstrap
-    return df.to_html(classes="table table-striped")
+
+def parse_facts(html):
+
+    # Read the facts table into rows of description, Mars and Earth values
+    rows = parse_table(html, ['description', 'Mars', 'Earth'])
+    return rows or None
 
 ### Hemisphere Images
 
-def hemispheres_images(browser):
+def hemispheres_images(browser=None, url=None):
+
+    url = url or HEMISPHERES_URL
+
+    # Every hemisphere page is static, so read the index once and fetch the detail pages in parallel
+    try:
+        detail_urls = cached_parse(url, 'hemisphere_links', lambda html: parse_hemisphere_links(html, url))
+        hemisphere_image_urls = crawl_hemispheres(detail_urls)
+        if hemisphere_image_urls and None not in hemisphere_image_urls:
+            return hemisphere_image_urls
+    except requests.RequestException:
+        failed('hemispheres', 'RequestException')
+
+    if browser is None:
+        return []
+
+    # Fall back to the browser, visiting each detail page directly instead of click/back
+    with _using(browser) as browser:
+        browser.visit(url)
+        browser.is_element_present_by_css('a.product-item img', wait_time=3)
+
+        # 2. Create a list to hold the images and titles.
+        hemisphere_image_urls = []
+
+        # 3. Retrieve the image urls and titles for each hemisphere.
+        for detail_url in parse_hemisphere_links(browser.html, url) or []:
+            browser.visit(detail_url)
+            hemispheres = parse_hemisphere(browser.html, detail_url)
+            if hemispheres is not None:
+                hemisphere_image_urls.append(hemispheres)
 
-    url = 'https://marshemispheres.com/'
-    browser.visit(url)
+    return hemisphere_image_urls
 
-    # 2. Create a list to hold the images and titles.
-    hemisphere_image_urls = []
 
-    # 3. Write code to retrieve the image urls and titles for each hemisphere.
-    links = browser.find_by_css('a.product-item img')
+def crawl_hemispheres(detail_urls):
 
-    # Loop through the links, click the link, find teh sample anchor, and return the href
-    for x in range(len(links)):
-        # create an empty dictionary to hold the image url's and titles       
-        hemispheres = {}
-        
-        # Navigate the browser to the URL
-        browser.find_by_css('a.product-item img')[x].click()
+    # Fetch the detail pages a few at a time, `map` keeps the results in page order
+    if not detail_urls:
+        return []
+    workers = min(HEMISPHERE_CONCURRENCY, len(detail_urls))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(_fetch_hemisphere, detail_urls))
 
-        # Scrape the full resolution image and the image title
-        sample_elem = browser.links.find_by_text('Sample').first
-        hemispheres['img_url'] = sample_elem['href']
 
-        hemispheres['title'] = browser.find_by_css('h2.title').text
-    
-        # Save the image link and title
-        hemisphere_image_urls.append(hemispheres)
+def _fetch_hemisphere(detail_url):
+    return cached_parse(detail_url, 'hemisphere', lambda html: parse_hemisphere(html, detail_url))
 
-        # Navigate back to get the next image
-        browser.back()
 
+def parse_hemisphere_links(html, base_url):
 
-    return hemisphere_image_urls
+    # Collect the detail page of every hemisphere thumbnail, in page order
+    return EXTRACTORS['hemisphere_links'].extract(html, base_url)['links'] or None
 
 
+def parse_hemisphere(html, base_url):
 
-if __name__ == "__main__":
+    # Scrape the full resolution image and the image title from a detail page
+    hemispheres = EXTRACTORS['hemisphere'].extract(html, base_url)
+    if hemispheres['img_url'] is None or hemispheres['title'] is None:
+        failed('hemispheres', 'missing_selector')
+        return None
 
+    return hemispheres
+
+
+
+if __name__ == "__main__":
 
-    # If running as script, print scraped data
-    print(scrape_all())
+    # If running as script, stream the scraped data as NDJSON, see cli.py
+    import cli
+    cli.main()
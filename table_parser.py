@@ -0,0 +1,71 @@
+# Minimal streaming parser for the first HTML table on a page
+from html.parser import HTMLParser
+
+
+class TableParser(HTMLParser):
+
+    # Collects the text of each cell row by row as the HTML is fed in, and stops
+    # keeping data once the first table closes
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.rows = []
+        self.header_rows = 0
+        self.depth = 0
+        self.done = False
+        self.in_head = False
+        self.row = None
+        self.row_is_header = False
+        self.cell = None
+
+    def handle_starttag(self, tag, attrs):
+        if self.done:
+            return
+        if tag == 'table':
+            self.depth += 1
+        elif self.depth == 1:
+            if tag == 'thead':
+                self.in_head = True
+            elif tag == 'tr':
+                self.row = []
+                self.row_is_header = True
+            elif tag in ('td', 'th') and self.row is not None:
+                self.cell = []
+                if tag == 'td':
+                    self.row_is_header = False
+
+    def handle_endtag(self, tag):
+        if self.done or self.depth == 0:
+            return
+        if tag == 'table':
+            self.depth -= 1
+            self.done = self.depth == 0
+        elif self.depth == 1:
+            if tag == 'thead':
+                self.in_head = False
+            elif tag in ('td', 'th') and self.cell is not None:
+                self.row.append(' '.join(''.join(self.cell).split()))
+                self.cell = None
+            elif tag == 'tr' and self.row is not None:
+                # Header rows are those inside <thead>, or leading rows made only of <th>
+                if self.in_head or (self.row_is_header and len(self.rows) == self.header_rows):
+                    self.header_rows += 1
+                self.rows.append(self.row)
+                self.row = None
+
+    def handle_data(self, data):
+        if self.cell is not None and not self.done:
+            self.cell.append(data)
+
+
+def parse_table(html, columns):
+
+    # Body rows of the first table as dicts keyed by `columns`
+    parser = TableParser()
+    parser.feed(html)
+    parser.close()
+    return [
+        dict(zip(columns, row))
+        for row in parser.rows[parser.header_rows:]
+        if len(row) == len(columns)
+    ]
@@ -0,0 +1,184 @@
+# Request handling shared by the Flask app (app.py) and the ASGI app (asgi.py)
+import datetime as dt
+import gzip
+import hashlib
+import json
+import os
+import threading
+import time
+import zlib
+import mars_store
+import metrics
+from mars_cache import INDEX_PROJECTION
+
+# Brotli is optional, responses fall back to gzip without it
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+# Fields of the mars document the JSON API can return
+API_FIELDS = [field for field in INDEX_PROJECTION if field != 'version']
+
+# Responses smaller than this are sent uncompressed
+COMPRESS_MIN_SIZE = 512
+
+# Seconds between background refreshes triggered by page views
+REFRESH_INTERVAL = int(os.environ.get('MARS_REFRESH_INTERVAL', 30))
+
+
+def to_json(value):
+    def default(o):
+        if isinstance(o, dt.datetime):
+            return o.isoformat()
+        return str(o)
+    return json.dumps(value, default=default, separators=(',', ':'))
+
+
+def accepted_encodings(header):
+
+    # Codings of an Accept-Encoding header that aren't refused with q=0
+    accepted = set()
+    for part in (header or '').split(','):
+        name, _, params = part.strip().partition(';')
+        try:
+            q = float(params.strip()[2:]) if params.strip().startswith('q=') else 1.0
+        except ValueError:
+            q = 0.0
+        if name and q > 0:
+            accepted.add(name.strip().lower())
+    return accepted
+
+
+def pick_encoding(header, size):
+    if size < COMPRESS_MIN_SIZE:
+        return None
+    accepted = accepted_encodings(header)
+    if brotli is not None and ('br' in accepted or '*' in accepted):
+        return 'br'
+    if 'gzip' in accepted or '*' in accepted:
+        return 'gzip'
+    return None
+
+
+def compress(body, encoding):
+    if encoding == 'br':
+        return brotli.compress(body)
+    if encoding == 'gzip':
+        return gzip.compress(body, compresslevel=6)
+    return body
+
+
+def api_fields(value):
+
+    # Fields selected by `?fields=a,b`, all of API_FIELDS when empty
+    fields = [f for f in (value or '').split(',') if f] or API_FIELDS
+    if any(field not in API_FIELDS for field in fields):
+        raise ValueError(f'unknown fields: {value!r}')
+    return fields
+
+
+def api_mars(mars, fields, accept_encoding):
+
+    # Body, encoding and ETag of /api/mars. The document only changes with
+    # last_modified, so it identifies each representation
+    mars = mars or {}
+    body = to_json({field: mars.get(field) for field in fields}).encode('utf-8')
+    encoding = pick_encoding(accept_encoding, len(body))
+    last_modified = mars.get('last_modified')
+    version = f"{last_modified.isoformat() if last_modified else ''}|{','.join(fields)}|{encoding}"
+    return body, encoding, hashlib.sha1(version.encode('utf-8')).hexdigest()
+
+
+def history_range(args):
+
+    # `start` and `end` query parameters as datetimes, ValueError when malformed
+    start = dt.datetime.fromisoformat(args['start']) if 'start' in args else None
+    end = dt.datetime.fromisoformat(args['end']) if 'end' in args else None
+    return start, end
+
+
+class NdjsonEncoder:
+
+    # One change per line, gzipped as a single stream when the client accepts it
+
+    def __init__(self, gzipped):
+        self.compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if gzipped else None
+
+    def encode(self, change):
+        line = (to_json(change) + '\n').encode('utf-8')
+        return self.compressor.compress(line) if self.compressor else line
+
+    def flush(self):
+        return self.compressor.flush() if self.compressor else b''
+
+
+def ndjson_lines(changes, gzipped):
+    encoder = NdjsonEncoder(gzipped)
+    for change in changes:
+        chunk = encoder.encode(change)
+        if chunk:
+            yield chunk
+    tail = encoder.flush()
+    if tail:
+        yield tail
+
+
+def news_body(articles, limit):
+
+    # The /api/news payload of one page of articles
+    cursor = mars_store.next_cursor(articles, limit)
+    for article in articles:
+        article['id'] = article.pop('_id')
+    return {'articles': articles, 'next': cursor}
+
+
+def news(db, cursor, limit):
+
+    # One page of /api/news, ValueError for a bad cursor or limit
+    query, sort, limit = mars_store.news_query(cursor, int(limit))
+    return news_body(list(db.news.find(query).sort(sort).limit(limit)), limit)
+
+
+class PageCache:
+
+    # The rendered index page, keyed by the document's last_modified
+
+    def __init__(self):
+        self.key = None
+        self.html = None
+        self.lock = threading.Lock()
+
+    def get(self, key, render):
+        with self.lock:
+            hit = key is not None and self.key == key
+            metrics.cache_result('page', hit)
+            if hit:
+                return self.html
+        with metrics.span('render', metrics.TEMPLATE_RENDER_SECONDS, template='index.html'):
+            html = render()
+        with self.lock:
+            self.key = key
+            self.html = html
+        return html
+
+
+class RefreshThrottle:
+
+    # Page views check for sources past their TTL at most once per `interval`
+
+    def __init__(self, interval=REFRESH_INTERVAL):
+        self.interval = interval
+        self.last = 0.0
+        self.lock = threading.Lock()
+
+    def stale(self, mars):
+
+        # Sources to queue a scrape for, empty while throttled
+        now = time.monotonic()
+        with self.lock:
+            if now - self.last < self.interval:
+                return []
+            self.last = now
+        return mars_store.stale_sources(mars)
@@ -0,0 +1,85 @@
+# Scrape worker: runs the jobs queued by the web app's /scrape route
+import os
+import time
+from contextlib import ExitStack
+from pymongo import MongoClient
+import scraping
+import mars_store
+import image_store
+import news_archive
+import scheduler
+import metrics
+from jobs import JobQueue
+
+
+MONGO_URI = os.environ.get('MONGO_URI', 'mongodb://localhost:27017/mars_app')
+
+# Seconds between checks for new jobs
+POLL_INTERVAL = float(os.environ.get('MARS_WORKER_POLL_INTERVAL', 1))
+
+# Running jobs older than this are assumed to belong to a dead worker
+JOB_TIMEOUT = int(os.environ.get('MARS_JOB_TIMEOUT', 600))
+
+# Also ingest the whole news archive on every scrape
+INGEST_NEWS = os.environ.get('MARS_INGEST_NEWS', '') == '1'
+
+# Also refresh each source on its own schedule, see scheduler.py
+SCHEDULE = os.environ.get('MARS_SCHEDULE', '') == '1'
+
+# Port of the worker's own /metrics endpoint, unset to disable it
+METRICS_PORT = os.environ.get('MARS_WORKER_METRICS_PORT')
+
+
+def scrape_and_save(db, sources=None, progress=None):
+    mars_data = scraping.scrape_all(progress=progress, sources=sources)
+
+    # Mirror the images locally so pages don't hotlink the full size originals
+    image_store.mirror_images(mars_data, scraping.http, scraping.cache)
+
+    # Only write the fields that changed and record them in the history collection
+    mars_store.save_scrape(db, mars_data)
+
+
+def run_scrape(db, queue, job):
+
+    # Hold the source locks so scheduled runs of the same sources wait their turn
+    with ExitStack() as stack:
+        for source in sorted(job.sources or mars_store.SOURCES):
+            stack.enter_context(scheduler.source_locks[source])
+        scrape_and_save(db, job.sources, lambda name: queue.source_done(job, name))
+
+    if INGEST_NEWS:
+        news_archive.ingest(db)
+
+
+def main():
+    db = MongoClient(MONGO_URI).get_default_database()
+    mars_store.ensure_indexes(db)
+    queue = JobQueue(db.scrape_jobs, total=len(mars_store.SOURCES))
+    queue.ensure_indexes()
+
+    if METRICS_PORT:
+        metrics.serve(int(METRICS_PORT))
+
+    # Resolve chromedriver and start the browser pool once, when the worker starts
+    scraping.pool.warm()
+
+    if SCHEDULE:
+        scheduler.Scheduler(lambda source: scrape_and_save(db, [source])).start()
+
+    while True:
+        queue.fail_stale(JOB_TIMEOUT)
+        job = queue.claim()
+        if job is None:
+            time.sleep(POLL_INTERVAL)
+            continue
+        try:
+            run_scrape(db, queue, job)
+        except Exception as e:
+            queue.finish(job, error=repr(e))
+        else:
+            queue.finish(job)
+
+
+if __name__ == "__main__":
+    main()